@@ -0,0 +1,279 @@
+# Microbenchmarks for bot.py hot paths. Runs offline:
+#   python bench.py                 run and compare against bench_baseline.json
+#   python bench.py --save          run and store the results as the new baseline
+#   python bench.py -k admin_orders only cases whose name contains the string
+# Handlers are called directly with lightweight fake Update/Context objects and
+# a stub bot; each case reports wall and CPU time and bytes allocated per call.
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_tmp = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ.setdefault("BOT_TOKEN", "123:bench")
+os.environ.setdefault("DB_FILE", os.path.join(_tmp, "bot.db"))
+os.environ.setdefault("USERS_LOG", os.path.join(_tmp, "users.log"))
+os.environ.setdefault("API_RATE", "1e9")
+
+import bot  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+REGRESSION = 2.0  # flag cases slower (CPU) or allocating more than this factor...
+REGRESSION_US = 10  # ...and by more than this many µs: below that it is scheduler noise
+REGRESSION_B = 256  # ...or by more than this many bytes
+
+
+# ================== FAKES ==================
+async def _noop(*args, **kwargs):
+    return FakeMessage(chat_id=kwargs.get("chat_id", 0))
+
+
+class StubBot:
+    def __getattr__(self, name):
+        return _noop
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.id = uid
+        self.full_name = f"User {uid}"
+
+
+class FakeChat:
+    def __init__(self, cid):
+        self.id = cid
+
+
+class FakePhoto:
+    def __init__(self, n):
+        self.file_id = f"file{n}"
+        self.file_unique_id = f"uniq{n}"
+
+
+class FakeMessage:
+    def __init__(self, chat_id=0, text=None, photo=None):
+        self.chat_id = chat_id
+        self.message_id = 1
+        self.text = text
+        self.photo = photo or []
+
+    reply_text = _noop
+
+
+class FakeCallbackQuery:
+    def __init__(self, user, data):
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(chat_id=user.id)
+
+    answer = _noop
+    edit_message_text = _noop
+
+
+class FakePreCheckout:
+    def __init__(self, user, payload, amount):
+        self.from_user = user
+        self.invoice_payload = payload
+        self.total_amount = amount
+        self.currency = "XTR"
+
+    answer = _noop
+
+
+class FakeUpdate:
+    def __init__(self, uid, text=None, data=None, photo=None, pre_checkout=None):
+        self.effective_user = FakeUser(uid)
+        self.effective_chat = FakeChat(uid)
+        self.message = FakeMessage(chat_id=uid, text=text, photo=photo)
+        self.callback_query = FakeCallbackQuery(self.effective_user, data) if data is not None else None
+        self.pre_checkout_query = pre_checkout
+
+
+class FakeContext:
+    def __init__(self, user_data=None, chat_data=None):
+        self.user_data = user_data if user_data is not None else {}
+        self.chat_data = chat_data if chat_data is not None else {}
+        self.bot = StubBot()
+
+
+# ================== MEASUREMENT ==================
+async def measure(make, handler, number, repeat=7):
+    # make() -> (update, context) for one call; setup is excluded from timings.
+    # Times are the best of `repeat` runs.
+    await handler(*make())
+    wall = cpu = float("inf")
+    for _ in range(repeat):
+        args = [make() for _ in range(number)]
+        w = time.perf_counter()
+        c = time.process_time()
+        for u, ctx in args:
+            await handler(u, ctx)
+        wall = min(wall, (time.perf_counter() - w) / number * 1e6)
+        cpu = min(cpu, (time.process_time() - c) / number * 1e6)
+
+    samples = [make() for _ in range(min(number, 50))]
+    tracemalloc.start()
+    total = 0
+    for u, c in samples:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await handler(u, c)
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {"wall_us": wall, "cpu_us": cpu, "alloc_b": total / len(samples)}
+
+
+def sync_case(fn):
+    async def handler(*args):
+        fn(*args)
+    return handler
+
+
+def _order_row(i):
+    return (
+        f"O{i:013d}", 1000 + i % 500, "User", f"u{i}@example.com", "ChatGPT 1 Month",
+        "USDT" if i % 3 else "STARS", None, "EN", 1700000000 + i, "WAITING_ADMIN" if i % 4 else "CONFIRMED",
+        "$5.99", "chatgpt",
+    )
+
+
+def seed_orders(n):
+    def q(conn):
+        with conn:
+            conn.execute("DELETE FROM orders")
+            conn.executemany(
+                f"INSERT INTO orders (id, {', '.join(bot.ORDER_FIELDS)}) VALUES (?{', ?' * len(bot.ORDER_FIELDS)})",
+                (_order_row(i) for i in range(n)),
+            )
+    bot.DB.run_sync(q)
+
+
+def seed_users(n):
+    bot.USERS._extend(range(1, n + 1))
+
+
+# ================== CASES ==================
+ADMIN = bot.ADMIN_USER_ID
+SVC = next(iter(bot.SERVICES))
+
+
+def cases():
+    # (name, setup, make, handler, number)
+    n = {"count": 0}
+
+    def uid():
+        n["count"] += 1
+        return 5_000_000 + n["count"]
+
+    def flow_ctx(**extra):
+        return FakeContext({"lang": "EN", "service": SVC, "pay": "USDT", **extra})
+
+    def pre_checkout():
+        u, stars = uid(), bot.SERVICES[SVC]["stars"]
+        return FakeUpdate(u, pre_checkout=FakePreCheckout(FakeUser(u), f"stars:{SVC}:{stars}", stars)), FakeContext()
+
+    yield "start", None, lambda: (FakeUpdate(uid(), text="/start"), FakeContext()), bot.start, 2000
+    yield "set_language", None, lambda: (FakeUpdate(uid(), data="lang:AR"), FakeContext()), bot.set_language, 2000
+    yield "service_select", None, lambda: (FakeUpdate(uid(), data=f"svc:{SVC}"), flow_ctx()), bot.service_select, 2000
+    yield "route_callback(svc:)", None, lambda: (FakeUpdate(uid(), data=f"svc:{SVC}"), flow_ctx()), bot.route_callback, 2000
+    yield "get_photo", None, lambda: (
+        FakeUpdate(uid(), photo=[FakePhoto(n["count"])]), flow_ctx(await_img=True)), bot.get_photo, 2000
+    yield "get_email", None, lambda: (
+        FakeUpdate(uid(), text="name@example.com"), flow_ctx(await_email=True, photo="file1")), bot.get_email, 500
+    yield "precheckout", None, pre_checkout, bot.precheckout, 2000
+
+    seed = lambda: seed_orders(1000)  # noqa: E731
+    yield "admin_actions(adm_ok)", seed, lambda: (
+        FakeUpdate(ADMIN, data=f"adm_ok:O{n['count'] % 1000:013d}"), FakeContext()), bot.admin_actions, 500
+    yield "admin_text_handler(msg)", None, lambda: (
+        FakeUpdate(ADMIN, text="hello"), FakeContext(chat_data={"msg_target": uid(), "msg_order_id": "O1"})
+    ), bot.admin_text_handler, 2000
+
+    for size in (10_000, 100_000):
+        yield f"admin_orders first page ({size // 1000}k)", lambda s=size: seed_orders(s), lambda: (
+            FakeUpdate(ADMIN, data="admin_orders"), FakeContext()), bot.admin_orders, 200
+        yield f"admin_orders deep page ({size // 1000}k)", None, lambda s=size: (
+            FakeUpdate(ADMIN, data=f"ao:n:O{s // 2:013d}:W:U"), FakeContext()), bot.admin_orders, 200
+
+    yield "track_user existing (1M)", lambda: seed_users(1_000_000), lambda: (
+        5 + n["count"] % 1000, None), sync_case(lambda u, _: bot.track_user(u)), 20000
+    # users new to the bot have arbitrary ids, not just ones above everyone seen so far
+    rng = random.Random(25)
+    yield "track_user new (1M)", None, lambda: (rng.randrange(2_000_000, 8_000_000_000), None), sync_case(
+        lambda u, _: bot.track_user(u)), 20000
+
+    key = SVC
+    s = bot.SERVICES[key]
+    render = [
+        ("render service_select (rebuild)", lambda: (bot._service_text(s, "EN"), bot._pay_kb("EN"))),
+        ("render service_select (cached)", lambda: (bot.service_text(key, "EN"), bot.pay_kb("EN"))),
+        ("render services_kb (rebuild)", bot._services_kb),
+        ("render services_kb (cached)", bot.services_kb),
+    ]
+    for name, fn in render:
+        yield name, None, lambda: (None, None), sync_case(lambda *_, f=fn: f()), 5000
+
+
+# ================== MAIN ==================
+async def run(selected):
+    bot.OUTBOX.start(StubBot())
+    results = {}
+    for name, setup, make, handler, number in cases():
+        if selected and selected not in name:
+            continue
+        if setup:
+            setup()
+        results[name] = await measure(make, handler, number)
+        bot.OUTBOX._queue = type(bot.OUTBOX._queue)()  # drop queued stub sends between cases
+    await bot.OUTBOX.stop(timeout=0)
+    return results
+
+
+def report(results, baseline):
+    print(f"{'case':<36}{'wall µs':>10}{'cpu µs':>10}{'alloc B':>10}{'vs base':>10}")
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        ratio = ""
+        if base:
+            cpu = r["cpu_us"] / max(base["cpu_us"], 1e-9)
+            alloc = r["alloc_b"] / max(base["alloc_b"], 1)
+            ratio = f"{cpu:.2f}x"
+            if (cpu > REGRESSION and r["cpu_us"] - base["cpu_us"] > REGRESSION_US) or \
+                    (alloc > REGRESSION and r["alloc_b"] - base["alloc_b"] > REGRESSION_B):
+                regressions.append(name)
+                ratio += " !"
+        print(f"{name:<36}{r['wall_us']:>10.1f}{r['cpu_us']:>10.1f}{r['alloc_b']:>10.0f}{ratio:>10}")
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--save", action="store_true", help="store results as the new baseline")
+    ap.add_argument("-k", default="", help="only run cases whose name contains this")
+    args = ap.parse_args()
+
+    t = time.perf_counter()
+    results = asyncio.run(run(args.k))
+    try:
+        with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    regressions = report(results, {} if args.save else baseline)
+    print(f"\ndone in {time.perf_counter() - t:.1f}s")
+    bot.DB.close()
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {BASELINE_FILE}")
+    elif regressions:
+        print("regressions:", ", ".join(regressions))
+        sys.exit(1)
@@ -5,14 +5,41 @@ import time
 import re
 import json
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import sqlite3
+import signal
+import sys
+import heapq
+import math
+import bisect
+import traceback
+import hmac
+import secrets
+import functools
+import itertools
+import io
+import csv
+import calendar
+import gzip
+import tempfile
+from array import array
+from pathlib import Path
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from PIL import Image  # optional: perceptual hashes of payment screenshots
+except ImportError:
+    Image = None
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     LabeledPrice,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -20,6 +47,11 @@ from telegram.ext import (
     MessageHandler,
     PreCheckoutQueryHandler,
     ContextTypes,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
+    TypeHandler,
     filters,
 )
 
@@ -35,9 +67,19 @@ SUPPORT_URL = f"https://t.me/{SUPPORT_USERNAME}"
 USDT_ADDRESS = "TTmfGLZXWNxQGfi7YymVGk4CGhCaP2Q88J"
 USDT_NETWORK = "TRC20"
 
-# Render PORT (health server)
+# Bot API server (override to use a local Bot API server or loadtest.py's stand-in)
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+
+# Render PORT (health server, and webhook in webhook mode)
 PORT = int(os.environ.get("PORT", 10000))
 
+# Webhook mode: set WEBHOOK_URL to the public base URL; otherwise the bot polls.
+# Several workers behind one URL must share WEBHOOK_SECRET.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"  # 0: don't call setWebhook (local testing)
+
 # ================== LOGGING ==================
 logging.basicConfig(
     level=logging.INFO,
@@ -45,43 +87,1399 @@ logging.basicConfig(
 )
 
 # ================== SERVICES ==================
-SERVICES = {
-    "disney":   {"name": "Disney+ 1 Month",         "usd": "$5.49", "stars": 450},
-    "chatgpt":  {"name": "ChatGPT 1 Month",         "usd": "$5.99", "stars": 470},
-    "yt":       {"name": "YouTube Premium 1 Month", "usd": "$5.99", "stars": 470},
-    "spotify":  {"name": "Spotify 1 Month",         "usd": "$4.99", "stars": 420},
-
-    # Test / Donation
-    "donation": {"name": "☕ Donation / Test Payment", "usd": "$0.10", "stars": 1},
-}
+# The catalog lives in services.json: {key: {"name", "usd", "stars"}}, menu
+# order = file order. Edits are picked up at runtime (see CATALOG below);
+# orders keep the price quoted when the service was selected.
+SERVICES_FILE = os.getenv("SERVICES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "services.json"))
+
+def load_services(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not data:
+        raise ValueError("catalog must be a non-empty object")
+    services = {}
+    for key, s in data.items():
+        if not (isinstance(key, str) and key.isidentifier() and len(key) <= 32):
+            raise ValueError(f"bad service key {key!r}")
+        if not (isinstance(s.get("name"), str) and isinstance(s.get("usd"), str)
+                and isinstance(s.get("stars"), int) and s["stars"] > 0):
+            raise ValueError(f"service {key!r} needs name, usd and a positive integer stars")
+        services[key] = {"name": s["name"], "usd": s["usd"], "stars": s["stars"]}
+    return services
+
+SERVICES = load_services(SERVICES_FILE)
 
 # ================== PERSISTENT USERS ==================
-USERS_FILE = "users.json"
-
-def load_users() -> set[int]:
+USERS_FILE = "users.json"  # legacy snapshot, migrated into USERS_LOG once
+USERS_LOG = os.getenv("USERS_LOG", "users.log")
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", 2))
+USERS_FLUSH_BATCH = 500
+USERS_RECENT = 10_000  # uid -> slot lookups cached for active users
+USERS_BLOCK = 512  # ids per block of the sorted index; an insert shifts one block
+USERS_SCAN = 20_000  # ids checked per step of audience() before yielding to the loop
+
+SEEN_WEEKS = 14  # weekly last-seen bitmaps kept; covers the longest "active in" segment (90 days)
+SEGMENT_ALL = "-:-:0"
+
+def week_of(ts: float = None) -> int:
+    return int(time.time() if ts is None else ts) // (7 * 86400)
+
+def since_week(days: int) -> int:
+    # first week counted as "active in the last `days` days" (whole weeks, so a bit generous)
+    return week_of() - math.ceil(days / 7)
+
+def parse_segment(segment) -> tuple:
+    # "<lang|->:<Y|N|->:<days>" -> (lang, purchased, days); anything else means everyone
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(int(x) for x in data)
-    except Exception:
-        return set()
+        lang, purchased, days = segment.split(":")
+        return None if lang == "-" else lang, {"Y": True, "N": False}.get(purchased), int(days)
+    except (AttributeError, ValueError):
+        return None, None, 0
+
+def parse_user_line(line: str) -> tuple:
+    # "[-]<id>[ L=<lang>][ P=1][ W=<week>]" -> (id, blocked, {attr: value})
+    head, *attrs = line.split(" ")
+    attrs = dict(a.split("=", 1) for a in attrs)
+    for k in ("P", "W"):
+        if k in attrs:
+            attrs[k] = int(attrs[k])
+    return int(head.lstrip("-")), head[0] == "-", attrs
+
+class UserRegistry:
+    # Append-only log of user lines (see parse_user_line): "<id>" adds a user
+    # or un-blocks them, "-<id>" marks them as having blocked the bot, and the
+    # attributes record language, a purchase and the last week seen. Lines are
+    # buffered and flushed in batches from a worker thread; a crash loses at
+    # most one flush window. The log is rewritten (compacted) to one line per
+    # user once it is mostly stale lines.
+    #
+    # In memory: user ids sorted in blocks of array('q') next to blocks of
+    # array('I') slots, and one bitmap per attribute over those slots ("B"
+    # blocked, "P" purchased, "L:<lang>", "W:<week>" seen that week), about
+    # 14 bytes per user. New users take the next slot wherever their id
+    # sorts; blocks split at 2 * USERS_BLOCK. Segments are ANDs/ORs of whole
+    # bitmaps done as big-int operations.
+
+    def __init__(self, path: str, legacy_path: str = None, db=None):
+        self.path = path
+        self.db = db  # for the purchased backfill from `orders`
+        self._keys: list[array] = []   # blocks of sorted user ids
+        self._vals: list[array] = []   # bitmap slot of _keys[b][i]
+        self._maxes: list[int] = []    # last id of each block
+        self._size = 0                 # slots in use
+        self._bits: dict[str, bytearray] = {}
+        self._cap = 0             # bitmap size in bytes
+        self._recent = {}         # uid -> slot for recently active users
+        self._week, self._week_ends = None, 0.0
+        self._blocked = 0
+        self._pending: list[str] = []
+        self._lines = 0
+        self._wake = None
+        self._task = None
+        self._load(legacy_path)
+
+    def _load(self, legacy_path):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        # A crash mid-write leaves a partial last line. Cut it off, or the
+        # next append would continue it into a different (phantom) user id.
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logging.warning("Dropping torn last line of %s: %r", self.path, data[end:])
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        lines = data[:end].decode("utf-8").split("\n")  # last element is ""
+        parsed = []
+        for line in lines[:-1]:
+            if line:
+                try:
+                    parsed.append(parse_user_line(line))
+                except ValueError:
+                    continue
+        self._extend(uid for uid, _, _ in parsed)
+        for uid, blocked, attrs in parsed:
+            self._apply(self._find(uid), blocked, attrs)
+        self._lines = len(parsed)
+        self._prune()
+
+        if not self._lines and legacy_path:
+            try:
+                with open(legacy_path, "r", encoding="utf-8") as f:
+                    legacy = [int(x) for x in json.load(f)]
+            except Exception:
+                legacy = []
+            self._pending.extend(map(str, self._extend(legacy)))
+        if self.db:
+            self._backfill_purchased()
+
+    def _backfill_purchased(self):
+        # One-off for customers who ordered before the P attribute existed
+        def q(conn):
+            if Database.migrated(conn, "users_log.purchased"):
+                return None
+            return [r[0] for r in conn.execute("SELECT DISTINCT user FROM orders")]
+        customers = self.db.run_sync(q)
+        if customers is None:
+            return
+        self._extend(customers)
+        lines = []
+        for uid in customers:
+            slot = self._find(uid)
+            if not self._bit("P", slot):
+                self._set("P", slot)
+                lines.append(f"{'-' if self._bit('B', slot) else ''}{uid} P=1")
+        if lines:
+            self._append(lines)  # on disk before the migration counts as done
+            self._lines += len(lines)
+        self.db.run_sync(Database.mark_migrated, "users_log.purchased")
+
+    # ---- slots and bitmaps ----
+    def _extend(self, uids) -> list:
+        # bulk add (loading, migration): one sort instead of an insert per id
+        new = sorted(set(uids).difference(uid for uid, _ in self._pairs()))
+        if new:
+            n = self._size
+            pairs = sorted(itertools.chain(self._pairs(), zip(new, range(n, n + len(new)))))
+            self._keys = [array("q", (uid for uid, _ in pairs[i:i + USERS_BLOCK]))
+                          for i in range(0, len(pairs), USERS_BLOCK)]
+            self._vals = [array("I", (slot for _, slot in pairs[i:i + USERS_BLOCK]))
+                          for i in range(0, len(pairs), USERS_BLOCK)]
+            self._maxes = [keys[-1] for keys in self._keys]
+            self._size = n + len(new)
+            self._grow()
+        return new
+
+    def _pairs(self, after: int = None):
+        # (uid, slot) in id order, from the first id > after
+        b = 0 if after is None else bisect.bisect_right(self._maxes, after)
+        for b in range(b, len(self._keys)):
+            keys, vals = self._keys[b], self._vals[b]
+            i = 0 if after is None else bisect.bisect_right(keys, after)
+            yield from zip(keys[i:], vals[i:])
+            after = None
+
+    def _grow(self):
+        need = (self._size + 7) // 8
+        if need > self._cap:
+            extra = max(need - self._cap, self._cap, 4096)
+            for bm in self._bits.values():
+                bm.extend(bytes(extra))
+            self._cap += extra
+
+    def _find(self, uid: int, insert: bool = False):
+        # slot of uid, or None if it is missing (with insert=True: a new slot)
+        maxes = self._maxes
+        b = bisect.bisect_left(maxes, uid)
+        if b < len(maxes):
+            keys = self._keys[b]
+            i = bisect.bisect_left(keys, uid)
+            if keys[i] == uid:
+                return self._vals[b][i]
+        elif maxes:
+            b -= 1  # past the last id: end of the last block
+            i = len(self._keys[b])
+        else:
+            b = i = 0
+        return self._insert(b, i, uid) if insert else None
+
+    def _slot_of(self, uid: int):
+        # _find() behind a small cache; a user's slot never changes
+        slot = self._recent.get(uid)
+        if slot is None:
+            slot = self._find(uid)
+            if slot is not None:
+                self._remember(uid, slot)
+        return slot
+
+    def _remember(self, uid: int, slot: int):
+        if len(self._recent) >= USERS_RECENT:
+            self._recent.clear()
+        self._recent[uid] = slot
+
+    def _insert(self, b: int, i: int, uid: int) -> int:
+        # uid at position i of block b (as found by _find)
+        slot = self._size
+        self._size += 1
+        if slot >= self._cap * 8:
+            self._grow()
+        if not self._keys:
+            self._keys.append(array("q"))
+            self._vals.append(array("I"))
+            self._maxes.append(uid)
+        keys, vals, maxes = self._keys[b], self._vals[b], self._maxes
+        keys.insert(i, uid)
+        vals.insert(i, slot)
+        if i == len(keys) - 1:
+            maxes[b] = uid
+        if len(keys) > 2 * USERS_BLOCK:
+            self._keys[b:b + 1] = keys[:USERS_BLOCK], keys[USERS_BLOCK:]
+            self._vals[b:b + 1] = vals[:USERS_BLOCK], vals[USERS_BLOCK:]
+            maxes[b:b + 1] = keys[USERS_BLOCK - 1], keys[-1]
+        return slot
+
+    def _bit(self, name: str, slot: int) -> bool:
+        bm = self._bits.get(name)
+        return bm is not None and bm[slot >> 3] >> (slot & 7) & 1
+
+    def _set(self, name: str, slot: int, on: bool = True):
+        bm = self._bits.get(name)
+        if bm is None:
+            if not on:
+                return
+            bm = self._bits[name] = bytearray(self._cap)
+        if on:
+            bm[slot >> 3] |= 1 << (slot & 7)
+        else:
+            bm[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    def _block(self, slot: int, blocked: bool):
+        if self._bit("B", slot) != blocked:
+            self._set("B", slot, blocked)
+            self._blocked += 1 if blocked else -1
+
+    def _apply(self, slot: int, blocked: bool, attrs: dict):
+        self._block(slot, blocked)
+        if "L" in attrs:
+            self._set_lang(slot, attrs["L"])
+        if "P" in attrs:
+            self._set("P", slot)
+        if "W" in attrs:
+            self._set(f"W:{attrs['W']}", slot)
+
+    def _set_lang(self, slot: int, lang: str, new: bool = False):
+        if not new:  # a new slot has no language bit to clear
+            byte, mask = slot >> 3, 1 << (slot & 7)
+            for name, bm in self._bits.items():
+                if name[0] == "L" and bm[byte] & mask:
+                    bm[byte] &= ~mask & 0xFF
+        self._set(f"L:{lang}", slot)
+
+    def _prune(self):
+        oldest = week_of() - SEEN_WEEKS
+        for name in [n for n in self._bits if n.startswith("W:") and int(n[2:]) < oldest]:
+            del self._bits[name]
+
+    def _mask(self, name: str) -> int:
+        return int.from_bytes(self._bits.get(name, b""), "little")
+
+    def _select(self, segment) -> int:
+        # bitmap (as an int over slots) of the non-blocked users in `segment`
+        lang, purchased, days = parse_segment(segment)
+        sel = ((1 << self._size) - 1) & ~self._mask("B")
+        if lang:
+            sel &= self._mask(f"L:{lang}")
+        if purchased is not None:
+            sel = sel & self._mask("P") if purchased else sel & ~self._mask("P")
+        if days:
+            seen = 0
+            for week in range(since_week(days), week_of() + 1):
+                seen |= self._mask(f"W:{week}")
+            sel &= seen
+        return sel
+
+    # ---- public ----
+    def __contains__(self, uid) -> bool:
+        slot = self._slot_of(uid)
+        return slot is not None and not self._bit("B", slot)
+
+    def __len__(self) -> int:
+        return self._size - self._blocked
+
+    def __iter__(self):
+        blocked = self._bits.get("B")
+        return (uid for uid, slot in self._pairs()
+                if not (blocked and blocked[slot >> 3] >> (slot & 7) & 1))
+
+    def add(self, uid: int, lang: str = None) -> bool:
+        # Record activity and, if given, the chosen language: True for a new
+        # user or one coming back after blocking the bot. Logs at most one
+        # line per user per week, plus one per language change.
+        if time.time() >= self._week_ends:
+            self._next_week()
+        seen_bm, seen = self._week
+        slot = self._recent.get(uid)
+        new = returning = False
+        if slot is None:
+            size = self._size
+            slot = self._find(uid, insert=True)
+            new = slot == size
+            self._remember(uid, slot)
+        byte, mask = slot >> 3, 1 << (slot & 7)
+        if not new:
+            blocked = self._bits.get("B")
+            returning = blocked is not None and blocked[byte] & mask
+            if lang and self._bit(f"L:{lang}", slot):
+                lang = None
+            if not (returning or lang) and seen_bm[byte] & mask:
+                return False
+            if returning:
+                self._block(slot, False)
+        seen_bm[byte] |= mask
+        if lang:
+            self._set_lang(slot, lang, new)
+            self._log(f"{uid} L={lang}{seen}")
+        else:
+            self._log(f"{uid}{seen}")
+        return bool(new or returning)
+
+    def _next_week(self):
+        # self._week: this week's "W:<week>" bitmap (grown in place, so it
+        # stays valid) and the " W=<week>" log suffix
+        week = week_of()
+        bm = self._bits.setdefault(f"W:{week}", bytearray(self._cap))
+        self._week, self._week_ends = (bm, f" W={week}"), (week + 1) * 7 * 86400
+        self._prune()
+
+    def discard(self, uid: int) -> bool:
+        # the user blocked the bot: kept, but out of every audience
+        slot = self._slot_of(uid)
+        if slot is None or self._bit("B", slot):
+            return False
+        self._block(slot, True)
+        self._log(f"-{uid}")
+        return True
+
+    def tag(self, uid: int, lang: str = None, purchased: bool = False):
+        slot = self._slot_of(uid)
+        if slot is None or self._bit("B", slot):
+            self.add(uid)
+            slot = self._slot_of(uid)
+        attrs = {}
+        if lang and not self._bit(f"L:{lang}", slot):
+            attrs["L"] = lang
+        if purchased and not self._bit("P", slot):
+            attrs["P"] = "1"
+        if attrs:
+            self._apply(slot, False, attrs)
+            self._log(" ".join([str(uid)] + [f"{k}={v}" for k, v in attrs.items()]))
+
+    async def count(self, segment=SEGMENT_ALL) -> int:
+        return self._select(segment).bit_count()
+
+    async def audience(self, after: int = 0, segment=SEGMENT_ALL, chunk: int = 500):
+        # sorted ids > after in `segment` (broadcast targets), `chunk` at a
+        # time. Selected once: users who arrive meanwhile are left out. The
+        # scan resumes by id after each USERS_SCAN ids, when it yields to the loop.
+        size = self._size
+        sel = self._select(segment).to_bytes(self._cap, "little")
+        batch = []
+        while True:
+            step = list(itertools.islice(self._pairs(after), USERS_SCAN))
+            if not step:
+                break
+            after = step[-1][0]
+            batch += [uid for uid, slot in step if slot < size and sel[slot >> 3] >> (slot & 7) & 1]
+            while len(batch) >= chunk:
+                yield batch[:chunk]
+                batch = batch[chunk:]
+            await asyncio.sleep(0)
+        if batch:
+            yield batch
+
+    def _log(self, line: str):
+        self._pending.append(line)
+        if len(self._pending) >= USERS_FLUSH_BATCH and self._wake:
+            self._wake.set()
+
+    def _append(self, batch: list[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{line}\n" for line in batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _snapshot(self):
+        # copies taken on the loop; the worker thread formats them
+        index, slots = array("q"), array("I")
+        for keys, vals in zip(self._keys, self._vals):
+            index += keys
+            slots += vals
+        return index, slots, {name: bytes(bm) for name, bm in self._bits.items()}
+
+    def _compact(self, snapshot):
+        index, slots, bits = snapshot
+        blocked, purchased = bits.get("B"), bits.get("P")
+        langs = [(name[2:], bm) for name, bm in bits.items() if name.startswith("L:")]
+        weeks = sorted(((int(name[2:]), bm) for name, bm in bits.items() if name.startswith("W:")), reverse=True)
+
+        def line(uid, slot):
+            byte, mask = slot >> 3, 1 << (slot & 7)
+            parts = [f"-{uid}" if blocked and blocked[byte] & mask else str(uid)]
+            parts += [f"L={lang}" for lang, bm in langs if bm[byte] & mask][:1]
+            if purchased and purchased[byte] & mask:
+                parts.append("P=1")
+            parts += [f"W={week}" for week, bm in weeks if bm[byte] & mask][:1]
+            return " ".join(parts)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(f"{line(uid, slot)}\n" for uid, slot in zip(index, slots)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def _write(self, batch: list[str]):
+        await asyncio.to_thread(self._append, batch)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await self._write(batch)
+        except Exception as e:
+            logging.exception("Failed to flush users log: %s", e)
+            self._pending[:0] = batch
+            return
+        self._lines += len(batch)
 
-def save_users(users: set[int]):
-    try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(sorted(list(users)), f)
-    except Exception:
+        if self._lines > 2 * self._size + 1000:
+            snapshot = self._snapshot()
+            try:
+                await asyncio.to_thread(self._compact, snapshot)
+                self._lines = len(snapshot[0])
+            except Exception as e:
+                logging.exception("Failed to compact users log: %s", e)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), USERS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+def track_user(user_id: int, lang: str = None):
+    USERS.add(user_id, lang)
+
+# ================== DATABASE ==================
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+
+class Database:
+    # A single sqlite connection (WAL mode) owned by one worker thread, so
+    # queries never run on the event loop and never race each other.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self._conn = None
+        self._executor.submit(self._open).result()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn = conn
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, self._conn, *args)
+
+    def run_sync(self, fn, *args):
+        return self._executor.submit(fn, self._conn, *args).result()
+
+    def reader(self):
+        # A separate read-only connection for long scans (exports) from
+        # another thread; WAL lets it read while the worker keeps writing.
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @staticmethod
+    def add_columns(conn, table: str, columns: dict):
+        # ALTER TABLE ... ADD COLUMN for columns an older database lacks
+        have = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        with conn:
+            for name, decl in columns.items():
+                if name not in have:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+    @staticmethod
+    def migrated(conn, name: str) -> bool:
+        # whether the one-off data migration `name` has already run here
+        conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)")
+        return conn.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone() is not None
+
+    @staticmethod
+    def mark_migrated(conn, name: str):
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO migrations (name) VALUES (?)", (name,))
+
+    def close(self):
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown()
+
+DB = Database(DB_FILE)
+
+# ================== ORDERS ==================
+# service is the display name at order time, service_key the catalog key (NULL on older orders)
+ORDER_FIELDS = ("user", "user_name", "email", "service", "pay", "photo", "lang", "created_at", "status", "price",
+                "service_key")
+
+_PRICE = re.compile(r"(\$|⭐)\s*(\d+)(?:\.(\d{1,2}))?")
+
+def price_value(price) -> tuple:
+    # "$5.99" -> ("usd_cents", 599), "⭐470" -> ("stars", 470), else (None, 0)
+    m = _PRICE.fullmatch(price or "")
+    if not m:
+        return None, 0
+    if m[1] == "⭐":
+        return "stars", int(m[2])
+    return "usd_cents", int(m[2]) * 100 + int((m[3] or "0").ljust(2, "0"))
+
+class OrderStore:
+    # Repository over the `orders` table. Every method is a coroutine that
+    # runs its query on the database thread.
+
+    def __init__(self, db: Database):
+        self.db = db
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                id         TEXT PRIMARY KEY,
+                user       INTEGER NOT NULL,
+                user_name  TEXT,
+                email      TEXT,
+                service    TEXT,
+                pay        TEXT,
+                photo      TEXT,
+                lang       TEXT,
+                created_at INTEGER NOT NULL,
+                status     TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS orders_status ON orders(status, created_at);
+            CREATE INDEX IF NOT EXISTS orders_user ON orders(user, created_at);
+            CREATE INDEX IF NOT EXISTS orders_created ON orders(created_at);
+            CREATE INDEX IF NOT EXISTS orders_status_id ON orders(status, id);
+            CREATE INDEX IF NOT EXISTS orders_pay_id ON orders(pay, id);
+            CREATE INDEX IF NOT EXISTS orders_status_pay_id ON orders(status, pay, id);
+            CREATE TABLE IF NOT EXISTS order_stats (
+                day     INTEGER NOT NULL,
+                service TEXT NOT NULL,
+                pay     TEXT NOT NULL,
+                metric  TEXT NOT NULL,
+                value   INTEGER NOT NULL,
+                PRIMARY KEY (day, service, pay, metric)
+            ) WITHOUT ROWID;
+        """)
+        Database.add_columns(conn, "orders", {"price": "TEXT", "service_key": "TEXT"})
+        if not conn.execute("SELECT 1 FROM order_stats LIMIT 1").fetchone():
+            OrderStore._backfill_stats(conn)
+
+    # ---- rollups ----
+    # order_stats holds counters per (UTC day, service, pay method), changed
+    # in the same transaction as the order itself, so reading them never
+    # touches `orders`. Metrics:
+    #   to:<STATUS>          orders that moved into STATUS that day
+    #   usd_cents / stars    confirmed revenue (a refund takes it back)
+    #   resp_s / resp_n      admin response time, WAITING_ADMIN -> decision
+    #   n:<STATUS>           orders currently in STATUS; kept on day 0
+    _STATS_UPSERT = (
+        "INSERT INTO order_stats (day, service, pay, metric, value) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (day, service, pay, metric) DO UPDATE SET value = value + excluded.value"
+    )
+
+    @staticmethod
+    def _stat_deltas(order: dict, old, new: str, now: int, timed: bool = True) -> dict:
+        deltas = {f"to:{new}": 1, f"n:{new}": 1}
+        if old:
+            deltas[f"n:{old}"] = -1
+        metric, amount = price_value(order.get("price"))
+        if metric and (old == "CONFIRMED") != (new == "CONFIRMED"):
+            deltas[metric] = amount if new == "CONFIRMED" else -amount
+        if timed and old == "WAITING_ADMIN" and new in ("CONFIRMED", "CANCELLED"):
+            deltas["resp_s"], deltas["resp_n"] = max(0, now - order["created_at"]), 1
+        return deltas
+
+    @staticmethod
+    def _count(conn, order: dict, old, new: str):
+        if old == new:
+            return
+        now = int(time.time())
+        day, service, pay = now // 86400, order.get("service") or "?", order.get("pay") or "?"
+        conn.executemany(OrderStore._STATS_UPSERT, [
+            (0 if m.startswith("n:") else day, service, pay, m, v)
+            for m, v in OrderStore._stat_deltas(order, old, new, now).items()
+        ])
+
+    @staticmethod
+    def _backfill_stats(conn):
+        # One-off for orders written before order_stats existed: everything
+        # is dated by the order's creation day and response times are unknown.
+        totals = defaultdict(int)
+        for row in conn.execute("SELECT service, pay, price, created_at, status FROM orders"):
+            order = dict(row)
+            day, service, pay = order["created_at"] // 86400, order["service"] or "?", order["pay"] or "?"
+            deltas = OrderStore._stat_deltas(order, None, "WAITING_ADMIN", order["created_at"])
+            if order["status"] != "WAITING_ADMIN":
+                more = OrderStore._stat_deltas(order, "WAITING_ADMIN", order["status"], order["created_at"], False)
+                for m, v in more.items():
+                    deltas[m] = deltas.get(m, 0) + v
+            for m, v in deltas.items():
+                totals[0 if m.startswith("n:") else day, service, pay, m] += v
+        with conn:
+            conn.executemany(OrderStore._STATS_UPSERT, [(*k, v) for k, v in totals.items() if v])
+
+    @staticmethod
+    def _row(row) -> dict:
+        return {k: row[k] for k in ORDER_FIELDS}
+
+    async def create(self, oid: str, order: dict):
+        def q(conn):
+            with conn:
+                conn.execute(
+                    f"INSERT INTO orders (id, {', '.join(ORDER_FIELDS)}) "
+                    f"VALUES (?{', ?' * len(ORDER_FIELDS)})",
+                    (oid, *(order.get(k) for k in ORDER_FIELDS)),
+                )
+                self._count(conn, order, None, order["status"])
+        await self.db.run(q)
+
+    async def get(self, oid: str):
+        def q(conn):
+            row = conn.execute("SELECT * FROM orders WHERE id = ?", (oid,)).fetchone()
+            return self._row(row) if row else None
+        return await self.db.run(q)
+
+    async def set_status(self, oid: str, status: str) -> bool:
+        def q(conn):
+            with conn:
+                row = conn.execute(
+                    "SELECT service, pay, price, created_at, status FROM orders WHERE id = ?", (oid,)
+                ).fetchone()
+                if not row:
+                    return False
+                conn.execute("UPDATE orders SET status = ? WHERE id = ?", (status, oid))
+                self._count(conn, dict(row), row["status"], status)
+            return True
+        return await self.db.run(q)
+
+    async def set_status_many(self, oids: list, status: str, only: str = "WAITING_ADMIN") -> list[dict]:
+        # Move the orders still in `only` to `status` in one transaction;
+        # returns those orders (the ones whose customers need notifying).
+        def q(conn):
+            marks = ", ".join("?" * len(oids))
+            with conn:
+                rows = conn.execute(
+                    f"SELECT * FROM orders WHERE id IN ({marks}) AND status = ?", (*oids, only)
+                ).fetchall()
+                conn.execute(
+                    f"UPDATE orders SET status = ? WHERE id IN ({marks}) AND status = ?", (status, *oids, only)
+                )
+                rows = [dict(r) for r in rows]
+                for order in rows:
+                    self._count(conn, order, only, status)
+            return rows
+        return await self.db.run(q) if oids else []
+
+    async def stats(self, days: int = 0) -> dict:
+        # Rollups for the last `days` UTC days (0 = all time) plus current
+        # status counts; the cost depends on days x services, not on orders.
+        def q(conn):
+            since = int(time.time()) // 86400 - days + 1 if days else 1
+            window = defaultdict(lambda: defaultdict(int))
+            for service, pay, metric, value in conn.execute(
+                "SELECT service, pay, metric, SUM(value) FROM order_stats WHERE day >= ? "
+                "GROUP BY service, pay, metric", (since,)
+            ):
+                window[service, pay][metric] = value
+            current = dict(conn.execute(
+                "SELECT substr(metric, 3), SUM(value) FROM order_stats WHERE day = 0 GROUP BY metric"
+            ).fetchall())
+            return {"window": window, "current": current}
+        return await self.db.run(q)
+
+    async def waiting(self, oids: list, status: str = "WAITING_ADMIN") -> list[str]:
+        # -> those of `oids` still in `status`
+        def q(conn):
+            return [r[0] for r in conn.execute(
+                f"SELECT id FROM orders WHERE id IN ({', '.join('?' * len(oids))}) AND status = ?", (*oids, status)
+            )]
+        return await self.db.run(q) if oids else []
+
+    async def page(self, cursor: str = None, newer: bool = False, status: str = None,
+                   pay: str = None, limit: int = 10):
+        # Keyset pagination over order ids (which sort by creation time).
+        # Returns (orders newest first, has_newer, has_older).
+        def q(conn):
+            where, args = [], []
+            if status:
+                where.append("status = ?")
+                args.append(status)
+            if pay:
+                where.append("pay = ?")
+                args.append(pay)
+
+            def select(op, cur, order, n):
+                cond = where + ([f"id {op} ?"] if cur else [])
+                sql = "SELECT * FROM orders"
+                if cond:
+                    sql += " WHERE " + " AND ".join(cond)
+                return conn.execute(
+                    f"{sql} ORDER BY id {order} LIMIT ?", (*args, *([cur] if cur else []), n)
+                ).fetchall()
+
+            if newer:
+                rows = select(">", cursor, "ASC", limit + 1)
+                more = len(rows) > limit
+                rows = rows[:limit][::-1]
+                has_newer, has_older = more, bool(rows) and bool(select("<", rows[-1]["id"], "DESC", 1))
+            else:
+                rows = select("<", cursor, "DESC", limit + 1)
+                more = len(rows) > limit
+                rows = rows[:limit]
+                has_newer, has_older = bool(rows) and bool(select(">", rows[0]["id"], "ASC", 1)), more
+            return [(r["id"], self._row(r)) for r in rows], has_newer, has_older
+        return await self.db.run(q)
+
+    async def count(self) -> int:
+        return await self.db.run(lambda conn: conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0])
+
+    async def counts(self) -> list:
+        # [(status, pay, n)] from the day-0 n:<STATUS> rollups, so a metrics
+        # scrape never scans `orders`. A status that has emptied stays at 0.
+        def q(conn):
+            return conn.execute(
+                "SELECT substr(metric, 3), pay, SUM(value) FROM order_stats "
+                "WHERE day = 0 AND metric LIKE 'n:%' GROUP BY metric, pay"
+            ).fetchall()
+        return [tuple(r) for r in await self.db.run(q)]
+
+# Admin order browser: page size and the one-letter filter codes used in
+# "ao:<dir>:<cursor>:<status>:<pay>" callback data.
+ADMIN_ORDERS_PAGE = 8
+ORDER_STATUS_CODES = {
+    "-": None, "W": "WAITING_ADMIN", "C": "CONFIRMED", "X": "CANCELLED", "R": "REFUNDED", "E": "EXPIRED",
+}
+ORDER_PAY_CODES = {"-": None, "U": "USDT", "S": "STARS"}
+
+# ================== CONVERSATION STATE ==================
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 5))
+
+class FlowState:
+    # The part of user_data that survives restarts, as one fixed-schema row.
+    __slots__ = ("lang", "service", "pay", "photo", "photo_uid", "charge_id", "quote", "flags")
+    COLUMNS = __slots__
+    AWAIT_IMG = 1
+    AWAIT_EMAIL = 2
+
+    def __init__(self, lang=None, service=None, pay=None, photo=None, photo_uid=None, charge_id=None,
+                 quote=None, flags=0):
+        self.lang, self.service, self.pay, self.flags = lang, service, pay, flags
+        self.photo, self.photo_uid, self.charge_id = photo, photo_uid, charge_id
+        self.quote = quote  # JSON of the selected service's catalog entry
+
+    @classmethod
+    def from_data(cls, d: dict):
+        flags = (cls.AWAIT_IMG if d.get("await_img") else 0) | (cls.AWAIT_EMAIL if d.get("await_email") else 0)
+        quote = json.dumps(d["quote"], ensure_ascii=False) if d.get("quote") else None
+        state = cls(d.get("lang"), d.get("service"), d.get("pay"), d.get("photo"), d.get("photo_uid"),
+                    d.get("charge_id"), quote, flags)
+        return state if any(state.row()) else None
+
+    def row(self) -> tuple:
+        return (self.lang, self.service, self.pay, self.photo, self.photo_uid, self.charge_id,
+                self.quote, self.flags)
+
+    def apply(self, d: dict):
+        for k in ("lang", "service", "pay", "photo", "photo_uid", "charge_id"):
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v
+        if self.quote:
+            d["quote"] = json.loads(self.quote)
+        if self.flags:
+            d["await_img"] = bool(self.flags & self.AWAIT_IMG)
+            d["await_email"] = bool(self.flags & self.AWAIT_EMAIL)
+
+class ChatState:
+    # The admin modes kept in chat_data.
+    __slots__ = ("broadcast_mode", "msg_target", "msg_order_id")
+    COLUMNS = __slots__
+
+    def __init__(self, broadcast_mode=None, msg_target=None, msg_order_id=None):
+        self.broadcast_mode, self.msg_target, self.msg_order_id = broadcast_mode, msg_target, msg_order_id
+
+    @classmethod
+    def from_data(cls, d: dict):
+        state = cls(d.get("broadcast_mode"), d.get("msg_target"), d.get("msg_order_id"))
+        return state if any(v is not None for v in state.row()) else None
+
+    def row(self) -> tuple:
+        return self.broadcast_mode, self.msg_target, self.msg_order_id
+
+    def apply(self, d: dict):
+        for k in self.COLUMNS:
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v
+
+class CompactPersistence(BasePersistence):
+    # Stores user_data as FlowState rows (`user_state`) and chat_data as
+    # ChatState rows (`chat_state`). Nothing is read at startup: a row is
+    # loaded on its user's/chat's first update (refresh_*). Changed entries
+    # are staged and written in one batch.
+    #
+    # shared=True is for several worker processes on one database: every
+    # update re-reads its rows and write_through() saves them right after
+    # the handlers ran.
+
+    TABLES = {"user": ("user_state", "user_id", FlowState), "chat": ("chat_state", "chat_id", ChatState)}
+
+    def __init__(self, db: Database, shared: bool = False, update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.shared = shared
+        self._loaded = {"user": set(), "chat": set()}
+        self._dirty = {}  # (kind, id) -> state, or None to delete
+        self._flush_task = None
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id INTEGER PRIMARY KEY,
+                lang    TEXT,
+                service TEXT,
+                pay     TEXT,
+                photo   TEXT,
+                flags   INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS chat_state (
+                chat_id        INTEGER PRIMARY KEY,
+                broadcast_mode INTEGER,
+                msg_target     INTEGER,
+                msg_order_id   TEXT
+            );
+        """)
+        Database.add_columns(conn, "user_state", {"photo_uid": "TEXT", "charge_id": "TEXT", "quote": "TEXT",
+                                                  "updated_at": "INTEGER"})
+        Database.add_columns(conn, "chat_state", {"updated_at": "INTEGER"})
+        conn.execute("CREATE INDEX IF NOT EXISTS user_state_pending ON user_state(updated_at) WHERE flags != 0")
+
+    async def _refresh(self, kind: str, key: int, data: dict):
+        if not self.shared:
+            if key in self._loaded[kind]:
+                return
+            self._loaded[kind].add(key)
+        table, pk, cls = self.TABLES[kind]
+
+        def q(conn):
+            return conn.execute(f"SELECT {', '.join(cls.COLUMNS)} FROM {table} WHERE {pk} = ?", (key,)).fetchone()
+        row = await self.db.run(q)
+        if self.shared:
+            data.clear()
+        if row and not data:
+            cls(*row).apply(data)
+
+    def _stage(self, kind: str, key: int, data):
+        self._dirty[kind, key] = self.TABLES[kind][2].from_data(data) if data else None
+        if not data:
+            self._loaded[kind].discard(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        # let the rest of this update_persistence() run stage its entries first
+        await asyncio.sleep(0)
+        while self._dirty:
+            batch, self._dirty = self._dirty, {}
+            try:
+                await self.db.run(self._write, batch)
+            except Exception as e:
+                logging.exception("Failed to persist conversation state: %s", e)
+                self._dirty = {**batch, **self._dirty}
+                return
+
+    def _write(self, conn, batch: dict):
+        now = int(time.time())
+        with conn:
+            for kind, (table, pk, cls) in self.TABLES.items():
+                cols = (pk, *cls.COLUMNS, "updated_at")
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES (?{', ?' * (len(cols) - 1)})",
+                    [(key, *st.row(), now) for (k, key), st in batch.items() if k == kind and st],
+                )
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE {pk} = ?",
+                    [(key,) for (k, key), st in batch.items() if k == kind and not st],
+                )
+
+    def evict(self, kind: str, key: int, unsaved: dict = None):
+        # The application dropped its in-memory copy (idle eviction): stage
+        # changes it had not saved yet, and read the row again next time.
+        if unsaved is not None and not self.shared:
+            self._stage(kind, key, unsaved)
+        self._loaded[kind].discard(key)
+
+    async def write_through(self, user_id, user_data, chat_id, chat_data):
+        batch = {}
+        if user_id is not None:
+            batch["user", user_id] = FlowState.from_data(user_data)
+        if chat_id is not None:
+            batch["chat", chat_id] = ChatState.from_data(chat_data)
+        if batch:
+            await self.db.run(self._write, batch)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        await self._refresh("chat", chat_id, chat_data)
+
+    # In shared mode write_through() is the only writer: the periodic
+    # update_persistence() would save this worker's copy of every user and
+    # chat it touched, seconds later, over rows other workers wrote since.
+    async def update_user_data(self, user_id: int, data: dict):
+        if not self.shared:
+            self._stage("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        if not self.shared:
+            self._stage("chat", chat_id, data)
+
+    async def drop_user_data(self, user_id: int):
+        if not self.shared:
+            self._stage("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        if not self.shared:
+            self._stage("chat", chat_id, None)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def flush(self):
+        if self._flush_task:
+            await self._flush_task
+        await self._flush()
+
+    # bot_data, callback_data and conversations are not used
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
         pass
 
-USERS = load_users()
+    async def update_bot_data(self, data):
+        pass
 
-def track_user(user_id: int):
-    if user_id not in USERS:
-        USERS.add(user_id)
-        save_users(USERS)
+    async def update_callback_data(self, data):
+        pass
 
-# ================== ORDERS (RAM) ==================
-ORDERS = {}  # order_id -> dict
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# ================== STATE BACKEND ==================
+# Where users, orders and conversation state live:
+#   local  - one process: users in the append-only log, state cached in memory
+#   sqlite - N worker processes sharing DB_FILE (WAL), each started with its
+#            own WORKER_ID: users in a table and state re-read/written through
+#            on every update, so any worker can continue a flow (or an
+#            admin's Confirm/Cancel) another one began
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+
+class SqliteUserRegistry(UserRegistry):
+    # Users in the shared `users` table, written in batches like the log;
+    # segments are answered by SQL over the same attributes. Membership
+    # checks only consult ids this worker has already seen.
+    COUNT_REFRESH = 30  # seconds between re-counting users added by other workers
+
+    def __init__(self, db: Database):
+        self._count = 0
+        self._counted_at = 0.0
+        super().__init__(path=None, db=db)
+
+    def _load(self, legacy_path):
+        def q(conn):
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)")
+            Database.add_columns(conn, "users", {
+                "lang": "TEXT", "purchased": "INTEGER NOT NULL DEFAULT 0",
+                "blocked": "INTEGER NOT NULL DEFAULT 0", "seen": "INTEGER",
+            })
+            if not Database.migrated(conn, "users.purchased"):
+                # one-off for customers who ordered before `purchased` existed
+                with conn:
+                    conn.execute(
+                        "INSERT INTO users (id, purchased) SELECT DISTINCT user, 1 FROM orders WHERE true "
+                        "ON CONFLICT (id) DO UPDATE SET purchased = 1"
+                    )
+                Database.mark_migrated(conn, "users.purchased")
+            return conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 0").fetchone()[0]
+        self._count = self.db.run_sync(q)
+        self._counted_at = time.monotonic()
+
+    @staticmethod
+    def _where(segment) -> tuple:
+        lang, purchased, days = parse_segment(segment)
+        where, args = ["blocked = 0"], []
+        if lang:
+            where.append("lang = ?")
+            args.append(lang)
+        if purchased is not None:
+            where.append("purchased = ?")
+            args.append(int(purchased))
+        if days:
+            where.append("seen >= ?")
+            args.append(since_week(days))
+        return " AND ".join(where), args
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        def q(conn):
+            return [r[0] for r in conn.execute("SELECT id FROM users WHERE blocked = 0")]
+        return iter(self.db.run_sync(q))
+
+    def add(self, uid: int, lang: str = None) -> bool:
+        if super().add(uid, lang):
+            self._count += 1
+            return True
+        return False
+
+    def discard(self, uid: int) -> bool:
+        # the row may exist even if this worker never saw the user
+        if super().discard(uid):
+            self._count -= 1
+        else:
+            self._log(f"-{uid}")
+        return True
+
+    async def count(self, segment=SEGMENT_ALL) -> int:
+        where, args = self._where(segment)
+        def q(conn):
+            return conn.execute(f"SELECT COUNT(*) FROM users WHERE {where}", args).fetchone()[0]
+        return await self.db.run(q)
+
+    async def audience(self, after: int = 0, segment=SEGMENT_ALL, chunk: int = 500):
+        where, args = self._where(segment)
+
+        def q(conn, after):
+            return [r[0] for r in conn.execute(
+                f"SELECT id FROM users WHERE id > ? AND {where} ORDER BY id LIMIT ?", (after, *args, chunk)
+            )]
+        while ids := await self.db.run(q, after):
+            yield ids
+            after = ids[-1]
+
+    async def _write(self, batch: list[str]):
+        recount = time.monotonic() - self._counted_at > self.COUNT_REFRESH
+        rows = []
+        for line in batch:
+            uid, blocked, attrs = parse_user_line(line)
+            rows.append((uid, int(blocked), attrs.get("L"), attrs.get("P", 0), attrs.get("W")))
+
+        def q(conn):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO users (id, blocked, lang, purchased, seen) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET blocked = excluded.blocked, "
+                    "lang = COALESCE(excluded.lang, lang), purchased = MAX(purchased, excluded.purchased), "
+                    "seen = MAX(COALESCE(seen, 0), COALESCE(excluded.seen, 0))",
+                    rows,
+                )
+            return conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 0").fetchone()[0] if recount else None
+        n = await self.db.run(q)
+        if n is not None:
+            self._count, self._counted_at = n, time.monotonic()
+
+    def _compact(self, snapshot):
+        pass  # the table holds no stale rows
+
+class StateBackend:
+    shared = False
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.orders = OrderStore(db)
+        self.users = self._users()
+        self.persistence = CompactPersistence(db, shared=self.shared)
+
+    def _users(self):
+        raise NotImplementedError
+
+class LocalBackend(StateBackend):
+    def _users(self):
+        return UserRegistry(USERS_LOG, legacy_path=USERS_FILE, db=self.db)
+
+class SqliteBackend(StateBackend):
+    shared = True
+
+    def _users(self):
+        return SqliteUserRegistry(self.db)
+
+STATE_BACKENDS = {"local": LocalBackend, "sqlite": SqliteBackend}
+if STATE_BACKEND not in STATE_BACKENDS:
+    raise RuntimeError(f"Unknown STATE_BACKEND {STATE_BACKEND!r} (use one of: {', '.join(STATE_BACKENDS)})")
+
+BACKEND = STATE_BACKENDS[STATE_BACKEND](DB)
+USERS = BACKEND.users
+ORDERS = BACKEND.orders
+
+async def write_through_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Last handler group in shared mode: save this update's state immediately
+    user = update.effective_user
+    chat = update.effective_chat
+    await BACKEND.persistence.write_through(
+        user.id if user else None, context.user_data if user else None,
+        chat.id if chat else None, context.chat_data if chat else None,
+    )
+
+# ================== METRICS ==================
+# Prometheus text exposition, served at /metrics by the HTTP server.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, n: float = 1):
+        self.values[labels] += n
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self.values = {}  # labels -> [count per bucket..., sum, count]
+
+    def observe(self, value: float, *labels):
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                v[i] += 1
+                break
+        v[-2] += value
+        v[-1] += 1
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        names = (*self.labels, "le")
+        for k, v in self.values.items():
+            acc = 0
+            for i, b in enumerate(self.buckets):
+                acc += v[i]
+                out.append(f"{self.name}_bucket{_labels(names, (*k, b))} {acc}")
+            out.append(f"{self.name}_bucket{_labels(names, (*k, '+Inf'))} {v[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labels, k)} {v[-2]}")
+            out.append(f"{self.name}_count{_labels(self.labels, k)} {v[-1]}")
+        return out
+
+HANDLER_UPDATES = Counter("bot_handler_updates_total", "Updates handled, by handler and outcome", ("handler", "outcome"))
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Handler latency", ("handler",))
+API_CALLS = Counter("bot_api_calls_total", "Bot API calls, by method and outcome", ("method", "outcome"))
+API_LATENCY = Histogram("bot_api_latency_seconds", "Bot API call latency", ("method",))
+METRICS = [HANDLER_UPDATES, HANDLER_LATENCY, API_CALLS, API_LATENCY]
+
+async def timed(fn, update, context):
+    # Pre/post hook around every handler callback
+    t = time.perf_counter()
+    outcome = "ok"
+    try:
+        return await fn(update, context)
+    except ApplicationHandlerStop:
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        dt = time.perf_counter() - t
+        HANDLER_LATENCY.observe(dt, fn.__name__)
+        HANDLER_UPDATES.inc(fn.__name__, outcome)
+        MONITOR.handler_done(fn.__name__, dt)
+
+def instrumented(fn):
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        return await timed(fn, update, context)
+    return wrapper
+
+class MetricsRequest(HTTPXRequest):
+    # Times every Bot API call (getUpdates uses its own request object)
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        t = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            API_CALLS.inc(endpoint, "network_error")
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - t, endpoint)
+        if code == 429:
+            API_CALLS.inc(endpoint, "retry_after")
+        elif code >= 400:
+            API_CALLS.inc(endpoint, "error")
+        else:
+            API_CALLS.inc(endpoint, "ok")
+        return code, payload
+
+async def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    lines += ["# HELP bot_outbox_queued Messages waiting in the outbox", "# TYPE bot_outbox_queued gauge",
+              f"bot_outbox_queued {len(OUTBOX)}"]
+    lines += ["# HELP bot_users Known users", "# TYPE bot_users gauge", f"bot_users {len(USERS)}"]
+    lines += ["# HELP bot_orders Orders by status and payment method", "# TYPE bot_orders gauge"]
+    for status, pay, n in await ORDERS.counts():
+        lines.append(f"bot_orders{_labels(('status', 'pay'), (status, pay))} {n}")
+    return "\n".join(lines) + "\n"
+
+# ================== LOOP MONITOR ==================
+LOOP_TICK = 0.1                                          # heartbeat period (s)
+LOOP_STALL = float(os.getenv("LOOP_STALL", 0.25))        # lag that gets a stack sample (s)
+LOOP_DEGRADED = float(os.getenv("LOOP_DEGRADED", 1.0))   # lag that makes /health report DEGRADED (s)
+LOOP_WINDOW = 10                                         # seconds of lag history behind /health
+LOOP_KEEP = 20                                           # stalls / slow handler calls kept
+LOOP_STACK_DEPTH = 25
+
+LOOP_LAG = Histogram("bot_loop_lag_seconds", "Event loop scheduling delay",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LOOP_STALLS = Counter("bot_loop_stalls_total", "Event loop stalls of at least LOOP_STALL seconds")
+METRICS += [LOOP_LAG, LOOP_STALLS]
+
+class LoopMonitor:
+    # A heartbeat task measures how late the loop wakes it up. A watchdog
+    # thread notices when the heartbeat is overdue, i.e. something is blocking
+    # the loop right now, and samples the loop thread's stack while the
+    # offending call is still on it. timed() reports every handler call so
+    # the slowest ones can be listed.
+
+    def __init__(self):
+        self.stalls = deque(maxlen=LOOP_KEEP)
+        self._slowest = []        # min-heap of (seconds, at, handler)
+        self._recent = deque()    # (monotonic, lag) for the last LOOP_WINDOW seconds
+        self._beat = time.monotonic()
+        self._sampled = None      # beat whose stall has a stack sample
+        self._loop_thread = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def handler_done(self, name: str, seconds: float):
+        if len(self._slowest) < LOOP_KEEP:
+            heapq.heappush(self._slowest, (seconds, time.time(), name))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, time.time(), name))
+
+    async def _heartbeat(self):
+        while True:
+            t = self._beat = time.monotonic()
+            await asyncio.sleep(LOOP_TICK)
+            now = time.monotonic()
+            lag = max(0.0, now - t - LOOP_TICK)
+            LOOP_LAG.observe(lag)
+            self._recent.append((now, lag))
+            while self._recent[0][0] < now - LOOP_WINDOW:
+                self._recent.popleft()
+            if lag >= LOOP_STALL:
+                LOOP_STALLS.inc()
+                if self.stalls and self.stalls[-1]["beat"] == t:
+                    self.stalls[-1]["lag"] = round(lag, 3)
+
+    def _watch(self):
+        while not self._stop.wait(LOOP_TICK / 2):
+            beat = self._beat
+            if time.monotonic() - beat - LOOP_TICK < LOOP_STALL or self._sampled == beat:
+                continue
+            self._sampled = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-LOOP_STACK_DEPTH:]
+            # the handler is the frame timed() awaited
+            handler = next((stack[i + 1].name for i in range(len(stack) - 2, -1, -1)
+                            if stack[i].name == "timed"), None)
+            self.stalls.append({
+                "beat": beat, "at": time.time(), "lag": None, "handler": handler,
+                "stack": [f"{f.filename}:{f.lineno} {f.name}: {f.line}" for f in stack],
+            })
+            logging.warning("Event loop blocked for >%.2fs in %s at %s", LOOP_STALL, handler or "?",
+                            f"{stack[-1].filename}:{stack[-1].lineno}")
+
+    def lag(self) -> tuple:
+        # -> (current stall, worst lag in the window)
+        now = max(0.0, time.monotonic() - self._beat - LOOP_TICK)
+        return now, max([now, *(lag for _, lag in self._recent)])
+
+    def snapshot(self) -> dict:
+        now, worst = self.lag()
+        return {
+            "lag_now": round(now, 3),
+            f"lag_max_{LOOP_WINDOW}s": round(worst, 3),
+            "degraded": worst >= LOOP_DEGRADED,
+            "stalls": [{k: v for k, v in st.items() if k != "beat"} for st in reversed(self.stalls)],
+            "slowest_handlers": [
+                {"handler": name, "seconds": round(sec, 3), "at": at}
+                for sec, at, name in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+MONITOR = LoopMonitor()
 
 # ================== UTILS ==================
 def is_admin(uid: int) -> bool:
@@ -90,8 +1488,48 @@ def is_admin(uid: int) -> bool:
 def valid_email(e: str) -> bool:
     return re.match(r"[^@]+@[^@]+\.[^@]+", e or "") is not None
 
-def new_order_id() -> str:
-    return f"O{int(time.time())}"
+# Order ids: "O" + 13 base36 chars encoding a 63-bit integer
+#   41 bits ms since ID_EPOCH_MS | 10 bits worker | 12 bits sequence
+# Fixed width, so ids sort by creation time as plain strings.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+# One process (local) can take any id. Workers sharing the database must each
+# get their own: two with the same id can mint the same order id.
+WORKER_ID = int(os.getenv("WORKER_ID", -1))
+if WORKER_ID == -1 and BACKEND.shared:
+    raise RuntimeError("WORKER_ID missing: with STATE_BACKEND=sqlite set a distinct 0-1023 per worker")
+if WORKER_ID == -1:
+    WORKER_ID = os.getpid() & 0x3FF
+if not 0 <= WORKER_ID <= 0x3FF:
+    raise RuntimeError(f"WORKER_ID {WORKER_ID} out of range (0-1023)")
+_B36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+class OrderIdGenerator:
+    def __init__(self, worker_id: int):
+        self.worker = worker_id << 12
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._seq = 0
+
+    def __call__(self) -> str:
+        with self._lock:
+            now = int(time.time() * 1000) - ID_EPOCH_MS
+            if now > self._last_ms:
+                self._last_ms, self._seq = now, 0
+            else:
+                # same ms, or the clock went backwards: keep counting on the
+                # last timestamp and borrow the next ms when the sequence wraps
+                self._seq = (self._seq + 1) & 0xFFF
+                if self._seq == 0:
+                    self._last_ms += 1
+            n = (self._last_ms << 22) | self.worker | self._seq
+
+        out = []
+        for _ in range(13):
+            n, r = divmod(n, 36)
+            out.append(_B36[r])
+        return "O" + "".join(reversed(out))
+
+new_order_id = OrderIdGenerator(WORKER_ID)
 
 def get_lang(context: ContextTypes.DEFAULT_TYPE) -> str:
     return context.user_data.get("lang", "EN")
@@ -130,7 +1568,10 @@ TEXT = {
         ),
         "admin_panel": "🛠 *Admin Control Panel*",
         "broadcast_prompt": "✍️ Send the broadcast message now:",
-        "broadcast_done": "✅ Broadcast done.\nSent: {sent}\nFailed: {failed}",
+        "broadcast_started": "📢 Broadcast started to {total} users.",
+        "broadcast_progress": "📢 Broadcasting… {done}/{total}\nSent: {sent}\nFailed: {failed}\nBlocked: {blocked}",
+        "broadcast_busy": "⏳ A broadcast is already running.",
+        "broadcast_done": "✅ Broadcast done.\nSent: {sent}\nFailed: {failed}\nBlocked: {blocked}",
         "no_orders": "📦 No orders yet.",
         "users_count": "👥 Total users: {n}",
         "msg_prompt": "✍️ Type the message you want to send to the customer:",
@@ -146,6 +1587,13 @@ TEXT = {
         ),
         "admin_notify_sent": "📨 Customer was notified successfully for order {oid}.",
         "admin_notify_failed": "⚠️ Failed to notify customer for order {oid}: {err}",
+        "pay_invalid": "This invoice has expired. Please choose the service again with /start.",
+        "nudge_img": "📸 Still there? Send the screenshot of your USDT transfer to finish your order.",
+        "nudge_email": "📧 Still there? Send the email you want the service activated on to finish your order.",
+        "expired_text": (
+            "⌛ *Your order has expired* because the payment could not be confirmed.\n\n"
+            "If you already paid, contact support below 👇"
+        ),
     },
     "AR": {
         "choose_lang": "🌐 اختر اللغة:",
@@ -179,7 +1627,10 @@ TEXT = {
         ),
         "admin_panel": "🛠 *لوحة تحكم الأدمن*",
         "broadcast_prompt": "✍️ اكتب رسالة الإعلان الآن:",
-        "broadcast_done": "✅ تم الإرسال.\nتم: {sent}\nفشل: {failed}",
+        "broadcast_started": "📢 بدأ الإرسال إلى {total} مستخدم.",
+        "broadcast_progress": "📢 جارٍ الإرسال… {done}/{total}\nتم: {sent}\nفشل: {failed}\nحظر: {blocked}",
+        "broadcast_busy": "⏳ يوجد إعلان قيد الإرسال.",
+        "broadcast_done": "✅ تم الإرسال.\nتم: {sent}\nفشل: {failed}\nحظر: {blocked}",
         "no_orders": "📦 لا يوجد طلبات بعد.",
         "users_count": "👥 عدد المستخدمين: {n}",
         "msg_prompt": "✍️ اكتب الرسالة لإرسالها للعميل:",
@@ -195,11 +1646,18 @@ TEXT = {
         ),
         "admin_notify_sent": "📨 تم إرسال إشعار للعميل للطلب {oid}.",
         "admin_notify_failed": "⚠️ فشل إرسال إشعار للعميل للطلب {oid}: {err}",
+        "pay_invalid": "انتهت صلاحية هذه الفاتورة. اختر الخدمة من جديد عبر /start.",
+        "nudge_img": "📸 هل ما زلت هنا؟ أرسل لقطة شاشة تحويل USDT لإكمال طلبك.",
+        "nudge_email": "📧 هل ما زلت هنا؟ أرسل الإيميل الذي تريد تفعيل الخدمة عليه لإكمال طلبك.",
+        "expired_text": (
+            "⌛ *انتهت صلاحية طلبك* لأنه لم يتم تأكيد الدفع.\n\n"
+            "إذا كنت قد دفعت، تواصل مع الدعم 👇"
+        ),
     }
 }
 
 # ================== KEYBOARDS ==================
-def lang_kb():
+def _lang_kb():
     return InlineKeyboardMarkup([
         [
             InlineKeyboardButton("🇬🇧 English", callback_data="lang:EN"),
@@ -207,31 +1665,51 @@ def lang_kb():
         ]
     ])
 
-def support_kb():
+def _support_kb():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📩 Contact Support", url=SUPPORT_URL)]
     ])
 
-def support_and_start_kb(lang="EN"):
+def _support_and_start_kb(lang="EN"):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📩 Contact Support", url=SUPPORT_URL)],
         [InlineKeyboardButton("🔄 Start Again" if lang=="EN" else "🔄 ابدأ من جديد", callback_data="start_again")]
     ])
 
-def services_kb():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"{v['name']} — {v['usd']} USD", callback_data=f"svc:{k}")]
-        for k, v in SERVICES.items()
-    ])
-
-def pay_kb(lang="EN"):
+SERVICES_PAGE = 8  # services per menu page
+
+def _services_page(services: dict, page: int) -> list:
+    keys = list(services)[page * SERVICES_PAGE:(page + 1) * SERVICES_PAGE]
+    return [(k, services[k]["name"], services[k]["usd"]) for k in keys]
+
+def _services_pages(services: dict) -> int:
+    return max(1, -(-len(services) // SERVICES_PAGE))
+
+def _services_kb(page: int = 0, services: dict = None):
+    services = SERVICES if services is None else services
+    rows = [
+        [InlineKeyboardButton(f"{name} — {usd} USD", callback_data=f"svc:{k}")]
+        for k, name, usd in _services_page(services, page)
+    ]
+    pages = _services_pages(services)
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅️", callback_data=f"svcp:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"svcp:{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("➡️", callback_data=f"svcp:{page + 1}"))
+        rows.append(nav)
+    return InlineKeyboardMarkup(rows)
+
+def _pay_kb(lang="EN"):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💵 Pay with USDT (Best Price)" if lang=="EN" else "💵 دفع USDT (أفضل سعر)", callback_data="pay_usdt")],
         [InlineKeyboardButton("⭐ Pay with Telegram Stars" if lang=="EN" else "⭐ الدفع بنجوم تيليجرام", callback_data="pay_stars")],
         [InlineKeyboardButton("⬅️ Back" if lang=="EN" else "⬅️ رجوع", callback_data="back_services")],
     ])
 
-def usdt_kb(lang="EN"):
+def _usdt_kb(lang="EN"):
     return InlineKeyboardMarkup([
         [
             InlineKeyboardButton("📋 Copy Address" if lang=="EN" else "📋 نسخ العنوان", callback_data="copy"),
@@ -250,13 +1728,647 @@ def admin_order_kb(oid):
         [InlineKeyboardButton("💬 Message Customer", callback_data=f"adm_msg:{oid}")],
     ])
 
-def admin_panel_kb():
+def _admin_panel_kb():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("👥 Users", callback_data="admin_users")],
         [InlineKeyboardButton("📦 Orders", callback_data="admin_orders")],
+        [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
         [InlineKeyboardButton("📢 Broadcast", callback_data="admin_broadcast")],
     ])
 
+# ================== RENDER CACHE ==================
+# Static keyboards and per-service texts are built once and shared by every
+# handler. Call refresh_render_cache() after changing TEXT; catalog changes
+# go through set_catalog(), which only rebuilds what they affect.
+RENDER = {}
+
+def _service_text(s: dict, lang: str) -> str:
+    return (
+        f"📦 *{s['name']}*\n"
+        f"💵 USDT: {s['usd']} (Best price)\n"
+        f"⭐ Telegram Stars: {s['stars']}\n\n"
+        f"{TEXT[lang]['choose_payment']}"
+    )
+
+def _catalog_render(services: dict, old_services: dict, old: dict) -> dict:
+    # Catalog-dependent RENDER entries for `services`, reusing the ones in
+    # `old` whose inputs did not change.
+    cache = {}
+    pages = _services_pages(services)
+    for page in range(pages):
+        sig = (pages, _services_page(services, page))
+        same = old.get(("services_sig", page)) == sig
+        cache["services_sig", page] = sig
+        cache["services_kb", page] = old["services_kb", page] if same else _services_kb(page, services)
+    for key, s in services.items():
+        same = old_services.get(key) == s
+        for lang in TEXT:
+            cache["svc", key, lang] = old["svc", key, lang] if same else _service_text(s, lang)
+    return cache
+
+def _static_render() -> dict:
+    cache = {
+        "lang_kb": _lang_kb(),
+        "support_kb": _support_kb(),
+        "admin_panel_kb": _admin_panel_kb(),
+    }
+    for lang in TEXT:
+        cache["support_and_start_kb", lang] = _support_and_start_kb(lang)
+        cache["pay_kb", lang] = _pay_kb(lang)
+        cache["usdt_kb", lang] = _usdt_kb(lang)
+    return cache
+
+def refresh_render_cache():
+    global RENDER
+    RENDER = {**_static_render(), **_catalog_render(SERVICES, {}, {})}
+
+def set_catalog(services: dict) -> list:
+    # Swap in a new catalog. SERVICES and RENDER are rebound together with no
+    # await in between, so a handler sees either the old pair or the new one.
+    global SERVICES, RENDER
+    changed = [k for k in {**SERVICES, **services} if SERVICES.get(k) != services.get(k)]
+    static = {k: v for k, v in RENDER.items() if not (isinstance(k, tuple) and k[0] in ("svc", "services_kb", "services_sig"))}
+    RENDER = {**static, **_catalog_render(services, SERVICES, RENDER)}
+    SERVICES = services
+    return changed
+
+def lang_kb():
+    return RENDER["lang_kb"]
+
+def support_kb():
+    return RENDER["support_kb"]
+
+def support_and_start_kb(lang="EN"):
+    return RENDER["support_and_start_kb", lang]
+
+def services_kb(page: int = 0):
+    return RENDER.get(("services_kb", page)) or RENDER["services_kb", 0]
+
+def pay_kb(lang="EN"):
+    return RENDER["pay_kb", lang]
+
+def usdt_kb(lang="EN"):
+    return RENDER["usdt_kb", lang]
+
+def admin_panel_kb():
+    return RENDER["admin_panel_kb"]
+
+def service_text(key: str, lang: str) -> str:
+    return RENDER["svc", key, lang]
+
+def quote_text(key: str, quote: dict, lang: str) -> str:
+    # the service message at the price the user was quoted
+    return service_text(key, lang) if SERVICES.get(key) == quote else _service_text(quote, lang)
+
+refresh_render_cache()
+
+# ================== CATALOG ==================
+CATALOG_POLL = float(os.getenv("CATALOG_POLL", 5))  # seconds between services.json checks
+
+class CatalogWatcher:
+    # Polls services.json's mtime/size/inode and swaps in the new catalog
+    # when it changes. A file that fails to parse or validate is logged and ignored;
+    # the running catalog stays in place.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stamp = self._stat()
+        self._task = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    async def check(self) -> list:
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return []
+        self._stamp = stamp
+        try:
+            services = await asyncio.to_thread(load_services, self.path)
+        except Exception as e:
+            logging.error("Ignoring invalid catalog %s: %s", self.path, e)
+            return []
+        changed = set_catalog(services)
+        if changed:
+            logging.info("Catalog reloaded: %d services, %d changed (%s%s)", len(services), len(changed),
+                         ", ".join(changed[:10]), ", ..." if len(changed) > 10 else "")
+        return changed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CATALOG_POLL)
+            try:
+                await self.check()
+            except Exception as e:
+                logging.exception("Catalog check failed: %s", e)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+CATALOG = CatalogWatcher(SERVICES_FILE)
+
+# ================== OUTBOX ==================
+# Every outbound Bot API call that isn't a direct reply goes through one
+# priority queue. Workers send through a global token bucket, retry with
+# backoff on RetryAfter and network errors, and resolve a future per message.
+API_RATE = float(os.getenv("API_RATE", 30))  # Bot API: ~30 messages/s per bot
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 8))
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_DEDUPE_KEYS = 10000
+
+# Priority classes: lower is sent first
+PRIO_ORDER = 0   # transactional: order notifications and confirmations
+PRIO_ADMIN = 1   # admin replies and status messages
+PRIO_BULK = 2    # broadcasts
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._ts = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # flood wait from Telegram: nobody sends until it has passed
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+API_BUCKET = TokenBucket(API_RATE, API_RATE)
+
+OUTBOX_MESSAGES = Counter("bot_outbox_messages_total", "Outbox messages, by priority and outcome", ("priority", "outcome"))
+METRICS.append(OUTBOX_MESSAGES)
+
+class Outbox:
+    def __init__(self):
+        self.bot = None
+        self._queue = None
+        self._seq = itertools.count()
+        self._recent = OrderedDict()  # idempotency key -> future
+        self._workers = []
+
+    def __len__(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def submit(self, method: str, priority: int = PRIO_ADMIN, key: str = None, **kwargs) -> asyncio.Future:
+        # Queue bot.<method>(**kwargs) and return at once. Awaiting the future
+        # gives the API result or the final error. A repeated key returns the
+        # earlier submission's future while it is in flight or after it
+        # succeeded; a failed send is forgotten so it can be retried.
+        if key is not None and key in self._recent:
+            return self._recent[key]
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(self._log_failure)
+        if key is not None:
+            self._recent[key] = fut
+            fut.add_done_callback(functools.partial(self._forget_failed, key))
+            if len(self._recent) > OUTBOX_DEDUPE_KEYS:
+                self._recent.popitem(last=False)
+        self._queue.put_nowait((priority, next(self._seq), method, kwargs, fut, 0))
+        return fut
+
+    def _forget_failed(self, key: str, fut: asyncio.Future):
+        if (fut.cancelled() or fut.exception()) and self._recent.get(key) is fut:
+            del self._recent[key]
+
+    @staticmethod
+    def _log_failure(fut: asyncio.Future):
+        if fut.cancelled() or not fut.exception():
+            return
+        # users blocking the bot is routine (e.g. during broadcasts)
+        level = logging.DEBUG if isinstance(fut.exception(), Forbidden) else logging.WARNING
+        logging.log(level, "Outbox send failed: %s", fut.exception())
+
+    def _retry(self, item: tuple, delay: float):
+        priority, _, method, kwargs, fut, attempt = item
+        asyncio.get_running_loop().call_later(
+            delay, self._queue.put_nowait, (priority, next(self._seq), method, kwargs, fut, attempt + 1)
+        )
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            priority, _, method, kwargs, fut, attempt = item
+            if fut.done():
+                continue
+            await API_BUCKET.acquire()
+            try:
+                result = await getattr(self.bot, method)(**kwargs)
+            except RetryAfter as e:
+                API_BUCKET.pause(retry_after_seconds(e))
+                OUTBOX_MESSAGES.inc(priority, "retry_after")
+                self._retry(item, 0)
+            except BadRequest as e:
+                # a NetworkError subclass, but permanent (chat not found, bad markup...)
+                OUTBOX_MESSAGES.inc(priority, "failed")
+                fut.set_exception(e)
+            except NetworkError as e:
+                # transport errors and timeouts
+                if attempt + 1 < OUTBOX_MAX_ATTEMPTS:
+                    OUTBOX_MESSAGES.inc(priority, "retry")
+                    self._retry(item, min(2 ** attempt, 30))
+                else:
+                    OUTBOX_MESSAGES.inc(priority, "failed")
+                    fut.set_exception(e)
+            except Exception as e:
+                OUTBOX_MESSAGES.inc(priority, "failed")
+                fut.set_exception(e)
+            else:
+                OUTBOX_MESSAGES.inc(priority, "sent")
+                fut.set_result(result)
+
+    def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(OUTBOX_WORKERS)]
+
+    async def stop(self, timeout: float = 10):
+        # give queued messages a moment to go out
+        deadline = time.monotonic() + timeout
+        while self._queue and not self._queue.empty() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+OUTBOX = Outbox()
+
+# ================== SCREENSHOT INDEX ==================
+SHOTS_CACHE_SIZE = int(os.getenv("SHOTS_CACHE_SIZE", 10000))  # screenshots kept in memory
+PHASH_WORKERS = int(os.getenv("PHASH_WORKERS", 2))
+
+def dhash(data: bytes) -> int:
+    # 64-bit difference hash: survives re-encoding, resizing and cropping of a
+    # few pixels, unlike file_unique_id. Runs in a worker process.
+    img = Image.open(io.BytesIO(data)).convert("L").resize((9, 8), Image.LANCZOS)
+    px = img.tobytes()
+    bits = 0
+    for y in range(8):
+        for x in range(8):
+            bits = (bits << 1) | (px[y * 9 + x] > px[y * 9 + x + 1])
+    return bits - (1 << 64) if bits >= 1 << 63 else bits  # as a signed SQLite INTEGER
+
+class ScreenshotIndex:
+    # Which orders used which payment screenshot, keyed on Telegram's
+    # file_unique_id (the same for every resend of the same file). Rows live
+    # in `screenshots`; recently used keys are kept in a bounded LRU. When
+    # Pillow is installed, a perceptual hash also catches re-uploads of the
+    # same image (screenshots of screenshots, recompressed copies).
+
+    def __init__(self, db: Database, cache_size: int = SHOTS_CACHE_SIZE):
+        self.db = db
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple] = OrderedDict()
+        self._pool = None
+        self._tasks = set()
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS screenshots (
+                file_unique_id TEXT NOT NULL,
+                order_id       TEXT NOT NULL,
+                phash          INTEGER,
+                created_at     INTEGER NOT NULL,
+                PRIMARY KEY (file_unique_id, order_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS screenshots_phash ON screenshots(phash);
+        """)
+
+    def _remember(self, uid: str, orders: tuple):
+        if not self.cache_size:
+            return
+        self._cache[uid] = orders
+        self._cache.move_to_end(uid)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def orders(self, uid: str) -> tuple:
+        if uid in self._cache:
+            self._cache.move_to_end(uid)
+            return self._cache[uid]
+
+        def q(conn):
+            return tuple(r[0] for r in conn.execute(
+                "SELECT order_id FROM screenshots WHERE file_unique_id = ? ORDER BY created_at", (uid,)))
+        orders = await self.db.run(q)
+        self._remember(uid, orders)
+        return orders
+
+    async def record(self, uid: str, oid: str) -> tuple:
+        # -> earlier orders that used the same screenshot
+        before = await self.orders(uid)
+
+        def q(conn):
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO screenshots (file_unique_id, order_id, created_at) VALUES (?, ?, ?)",
+                    (uid, oid, int(time.time())),
+                )
+        await self.db.run(q)
+        self._remember(uid, before + (oid,))
+        return before
+
+    async def _similar(self, bot, uid: str, oid: str, file_id: str) -> list:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(PHASH_WORKERS)
+        f = await bot.get_file(file_id)
+        data = bytes(await f.download_as_bytearray())
+        h = await asyncio.get_running_loop().run_in_executor(self._pool, dhash, data)
+
+        def q(conn):
+            with conn:
+                conn.execute("UPDATE screenshots SET phash = ? WHERE file_unique_id = ?", (h, uid))
+            return [r[0] for r in conn.execute(
+                "SELECT DISTINCT order_id FROM screenshots WHERE phash = ? AND file_unique_id != ?", (h, uid))]
+        return await self.db.run(q)
+
+    def check_similar(self, bot, uid: str, oid: str, file_id: str):
+        # Background: hash the image and tell the admin about look-alikes
+        if Image is None:
+            return
+
+        async def run():
+            try:
+                similar = await self._similar(bot, uid, oid, file_id)
+            except Exception as e:
+                logging.warning("Screenshot hash for %s failed: %s", oid, e)
+                return
+            if similar:
+                OUTBOX.submit(
+                    "send_message", PRIO_ORDER, key=f"similar:{oid}",
+                    chat_id=ADMIN_USER_ID,
+                    text=f"⚠️ Screenshot of {oid} looks like the one in: {', '.join(similar)}",
+                )
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+# ================== PAYMENTS ==================
+class PaymentLedger:
+    # Telegram Stars payments keyed by telegram_payment_charge_id. Recording
+    # a charge is idempotent, so a successful_payment update delivered twice
+    # (e.g. re-fetched after a polling restart) is only acted on once, and a
+    # charge can be linked to at most one order.
+
+    def __init__(self, db: Database):
+        self.db = db
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS payments (
+                charge_id  TEXT PRIMARY KEY,
+                user       INTEGER NOT NULL,
+                service    TEXT NOT NULL,
+                amount     INTEGER NOT NULL,
+                order_id   TEXT,
+                status     TEXT NOT NULL DEFAULT 'PAID',
+                created_at INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE UNIQUE INDEX IF NOT EXISTS payments_order ON payments(order_id);
+            CREATE INDEX IF NOT EXISTS payments_user ON payments(user, created_at);
+        """)
+
+    async def record(self, charge_id: str, user: int, service: str, amount: int) -> bool:
+        # -> False if this charge was already recorded
+        def q(conn):
+            with conn:
+                return conn.execute(
+                    "INSERT OR IGNORE INTO payments (charge_id, user, service, amount, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (charge_id, user, service, amount, int(time.time())),
+                ).rowcount > 0
+        return await self.db.run(q)
+
+    async def link(self, charge_id: str, oid: str) -> bool:
+        # -> False if the charge already paid for another order
+        def q(conn):
+            with conn:
+                return conn.execute(
+                    "UPDATE payments SET order_id = ? WHERE charge_id = ? AND order_id IS NULL", (oid, charge_id)
+                ).rowcount > 0
+        return await self.db.run(q)
+
+    async def find(self, ref: str) -> dict | None:
+        # by charge id or by order id (both indexed)
+        def q(conn):
+            row = conn.execute("SELECT * FROM payments WHERE charge_id = ?", (ref,)).fetchone() or \
+                conn.execute("SELECT * FROM payments WHERE order_id = ?", (ref,)).fetchone()
+            return dict(row) if row else None
+        return await self.db.run(q)
+
+    async def set_status(self, charge_id: str, status: str):
+        def q(conn):
+            with conn:
+                conn.execute("UPDATE payments SET status = ? WHERE charge_id = ?", (status, charge_id))
+        await self.db.run(q)
+
+PAYMENTS = PaymentLedger(DB)
+
+# ================== BROADCAST ==================
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))  # queued bulk messages
+BROADCAST_CHUNK = 500          # users per checkpoint
+BROADCAST_PROGRESS_EVERY = 5   # seconds between progress edits
+BROADCAST_LEASE = 120          # seconds without a checkpoint before another worker may take a job over
+
+class Broadcaster:
+    # Runs one broadcast at a time as a background task. Progress is saved to
+    # the `broadcasts` table after every chunk, so an interrupted broadcast
+    # resumes after a restart (re-sending at most one chunk). With several
+    # workers on one database a job is leased by the process running it
+    # (owner + heartbeat), so exactly one of them sends or resumes it.
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.owner = os.getpid()
+        self._task = None
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                text          TEXT NOT NULL,
+                chat_id       INTEGER NOT NULL,
+                status_msg_id INTEGER,
+                cursor        INTEGER NOT NULL DEFAULT 0,
+                total         INTEGER NOT NULL DEFAULT 0,
+                sent          INTEGER NOT NULL DEFAULT 0,
+                failed        INTEGER NOT NULL DEFAULT 0,
+                blocked       INTEGER NOT NULL DEFAULT 0,
+                done          INTEGER NOT NULL DEFAULT 0,
+                created_at    INTEGER NOT NULL
+            );
+        """)
+        Database.add_columns(conn, "broadcasts", {"owner": "INTEGER", "heartbeat": "INTEGER", "segment": "TEXT"})
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, text: str, chat_id: int, segment: str = SEGMENT_ALL) -> bool:
+        if self.running or await self.db.run(self._leased):
+            return False
+        total = await USERS.count(segment)
+        msg = await OUTBOX.submit(
+            "send_message", PRIO_ADMIN, chat_id=chat_id, text=TEXT["EN"]["broadcast_started"].format(total=total)
+        )
+        job = {
+            "text": text, "chat_id": chat_id, "status_msg_id": msg.message_id, "segment": segment,
+            "cursor": 0, "total": total, "sent": 0, "failed": 0, "blocked": 0, "done": 0,
+        }
+
+        def q(conn):
+            with conn:
+                cur = conn.execute(
+                    "INSERT INTO broadcasts (text, chat_id, status_msg_id, total, created_at, owner, heartbeat, segment) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (text, chat_id, msg.message_id, total, int(time.time()), self.owner, int(time.time()), segment),
+                )
+            return cur.lastrowid
+        job["id"] = await self.db.run(q)
+        self._task = asyncio.create_task(self._run(job))
+        return True
+
+    def _leased(self, conn) -> bool:
+        # an unfinished job another live worker is running
+        return conn.execute(
+            "SELECT 1 FROM broadcasts WHERE done = 0 AND owner IS NOT NULL AND owner != ? AND heartbeat >= ?",
+            (self.owner, int(time.time()) - BROADCAST_LEASE),
+        ).fetchone() is not None
+
+    async def resume(self):
+        def q(conn):
+            row = conn.execute("SELECT * FROM broadcasts WHERE done = 0 ORDER BY id DESC LIMIT 1").fetchone()
+            if not row:
+                return None
+            now = int(time.time())
+            with conn:
+                claimed = conn.execute(
+                    "UPDATE broadcasts SET owner = ?, heartbeat = ? "
+                    "WHERE id = ? AND (owner IS NULL OR owner = ? OR heartbeat < ?)",
+                    (self.owner, now, row["id"], self.owner, now - BROADCAST_LEASE),
+                ).rowcount
+            return dict(row) if claimed else None
+        if self.running:
+            return
+        job = await self.db.run(q)
+        if job:
+            logging.info("Resuming broadcast %s after user %s", job["id"], job["cursor"])
+            self._task = asyncio.create_task(self._run(job))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _save(self, job: dict):
+        def q(conn):
+            with conn:
+                conn.execute(
+                    "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, done = ?, heartbeat = ? "
+                    "WHERE id = ?",
+                    (job["cursor"], job["sent"], job["failed"], job["blocked"], job["done"], int(time.time()),
+                     job["id"]),
+                )
+        await self.db.run(q)
+
+    async def _send(self, uid: int, text: str, sem: asyncio.Semaphore) -> str:
+        async with sem:
+            try:
+                await OUTBOX.submit("send_message", PRIO_BULK, chat_id=uid, text=text)
+                return "sent"
+            except Forbidden:
+                USERS.discard(uid)
+                return "blocked"
+            except TelegramError:
+                return "failed"
+
+    def _progress(self, job: dict, key: str):
+        done = job["sent"] + job["failed"] + job["blocked"]
+        OUTBOX.submit(
+            "edit_message_text", PRIO_ADMIN,
+            chat_id=job["chat_id"],
+            message_id=job["status_msg_id"],
+            text=TEXT["EN"][key].format(**{**job, "done": done}),
+        )
+
+    async def _run(self, job: dict):
+        audience = USERS.audience(job["cursor"], job.get("segment") or SEGMENT_ALL, BROADCAST_CHUNK)
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_progress = time.monotonic()
+        try:
+            async for chunk in audience:
+                results = await asyncio.gather(*(self._send(uid, job["text"], sem) for uid in chunk))
+                for r in results:
+                    job[r] += 1
+                job["cursor"] = chunk[-1]
+                await self._save(job)
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_EVERY:
+                    last_progress = time.monotonic()
+                    self._progress(job, "broadcast_progress")
+
+            job["done"] = 1
+            await self._save(job)
+            self._progress(job, "broadcast_done")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception("Broadcast %s failed: %s", job.get("id"), e)
+
+BROADCASTS = Broadcaster(DB)
+# other workers record screenshots too, so shared mode always asks the database
+SHOTS = ScreenshotIndex(DB, cache_size=0 if BACKEND.shared else SHOTS_CACHE_SIZE)
+
 # ================== START / LANGUAGE ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     track_user(update.effective_user.id)
@@ -268,7 +2380,7 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     lang = q.data.split(":")[1]
     context.user_data["lang"] = lang
-    track_user(q.from_user.id)
+    track_user(q.from_user.id, lang)
 
     await q.message.reply_text(
         TEXT[lang]["welcome"],
@@ -296,37 +2408,187 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await q.message.reply_text(TEXT["EN"]["users_count"].format(n=len(USERS)))
 
+STATS_WINDOWS = {1: "Today", 7: "7 days", 30: "30 days", 0: "All time"}
+
+def _fmt_secs(s: float) -> str:
+    return f"{s / 3600:.1f}h" if s >= 3600 else f"{s / 60:.0f}m"
+
+def stats_text(stats: dict, days: int) -> str:
+    total = defaultdict(int)
+    by_service = defaultdict(lambda: defaultdict(int))
+    for (service, pay), metrics in stats["window"].items():
+        total[f"pay:{pay}"] += metrics["to:WAITING_ADMIN"]
+        for m, v in metrics.items():
+            total[m] += v
+            by_service[service][m] += v
+    decided = total["to:CONFIRMED"] + total["to:CANCELLED"] + total["to:EXPIRED"]
+    lines = [
+        f"📊 Stats — {STATS_WINDOWS[days]}",
+        "",
+        f"📦 Orders: {total['to:WAITING_ADMIN']} (USDT {total['pay:USDT']} · ⭐ {total['pay:STARS']})",
+        f"✅ {total['to:CONFIRMED']} · ❌ {total['to:CANCELLED']} · ⌛ {total['to:EXPIRED']} · "
+        f"↩️ {total['to:REFUNDED']}",
+        f"📈 Confirmation rate: {total['to:CONFIRMED'] / decided:.1%}" if decided else "📈 Confirmation rate: —",
+        f"⏱ Admin response: {_fmt_secs(total['resp_s'] / total['resp_n'])} avg" if total["resp_n"]
+        else "⏱ Admin response: —",
+        f"💰 Revenue: ${total['usd_cents'] / 100:,.2f} · ⭐ {total['stars']:,}",
+        f"⏳ Waiting now: {stats['current'].get('WAITING_ADMIN', 0)}",
+    ]
+    if by_service:
+        lines += ["", "By service:"]
+        for service, m in sorted(by_service.items(), key=lambda kv: -kv[1]["to:WAITING_ADMIN"]):
+            lines.append(
+                f"• {service}: {m['to:WAITING_ADMIN']} orders, {m['to:CONFIRMED']} ✅, "
+                f"${m['usd_cents'] / 100:,.2f} · ⭐ {m['stars']:,}"
+            )
+    return "\n".join(lines)
+
+def stats_kb(days: int):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"• {label} •" if d == days else label, callback_data=f"st:{d}")
+        for d, label in STATS_WINDOWS.items()
+    ]])
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /stats [days], the panel's Stats button, and st:<days> window switches
+    q = update.callback_query
+    if q:
+        await q.answer()
+    if not is_admin(update.effective_user.id):
+        return
+    if q:
+        days = int(q.data.partition(":")[2] or 7)
+    else:
+        arg = context.args[0] if context.args else "7"
+        days = int(arg) if arg.isdigit() and int(arg) in STATS_WINDOWS else None
+        if days is None:
+            await update.message.reply_text("Usage: /stats [1|7|30|0]  (0 = all time)")
+            return
+    text = stats_text(await ORDERS.stats(days), days)
+    if q and q.data.startswith("st:"):
+        try:
+            await q.edit_message_text(text, reply_markup=stats_kb(days))
+        except BadRequest:
+            pass  # same window clicked again: "message is not modified"
+    else:
+        await update.effective_message.reply_text(text, reply_markup=stats_kb(days))
+
+def _next_code(codes: dict, code: str) -> str:
+    keys = list(codes)
+    return keys[(keys.index(code) + 1) % len(keys)]
+
+def admin_orders_kb(first, last, has_newer, has_older, st, pay):
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"ao:p:{first}:{st}:{pay}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("Older ➡️", callback_data=f"ao:n:{last}:{st}:{pay}"))
+    filters_row = [
+        InlineKeyboardButton(f"Status: {ORDER_STATUS_CODES[st] or 'All'}",
+                             callback_data=f"ao:f:-:{_next_code(ORDER_STATUS_CODES, st)}:{pay}"),
+        InlineKeyboardButton(f"Pay: {ORDER_PAY_CODES[pay] or 'All'}",
+                             callback_data=f"ao:f:-:{st}:{_next_code(ORDER_PAY_CODES, pay)}"),
+    ]
+    return InlineKeyboardMarkup([row for row in (nav, filters_row) if row])
+
 async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     if not is_admin(q.from_user.id):
         return
-    if not ORDERS:
-        await q.message.reply_text(TEXT["EN"]["no_orders"])
-        return
 
-    lines = ["📦 All Orders:\n"]
-    for oid, o in list(ORDERS.items())[::-1]:
-        lines.append(
-            f"🆔 {oid}\n"
-            f"📦 {o['service']}\n"
-            f"💳 {o['pay']}\n"
-            f"📧 {o['email']}\n"
-            f"👤 {o.get('user_name','')}\n"
-            f"———"
-        )
-    text = "\n".join(lines)
-    if len(text) > 3800:
-        text = text[-3800:]
-    await q.message.reply_text(text)
+    # "admin_orders" opens the first page; "ao:..." pages/filters in place
+    if q.data == "admin_orders":
+        direction, cursor, st, pay = "f", "-", "-", "-"
+    else:
+        parts = q.data.split(":")
+        if len(parts) != 5 or parts[3] not in ORDER_STATUS_CODES or parts[4] not in ORDER_PAY_CODES:
+            return
+        _, direction, cursor, st, pay = parts
+
+    orders, has_newer, has_older = await ORDERS.page(
+        cursor=None if cursor == "-" else cursor,
+        newer=direction == "p",
+        status=ORDER_STATUS_CODES[st],
+        pay=ORDER_PAY_CODES[pay],
+        limit=ADMIN_ORDERS_PAGE,
+    )
+
+    if orders:
+        lines = ["📦 Orders:\n"]
+        for oid, o in orders:
+            lines.append(
+                f"🆔 {oid}\n"
+                f"📦 {o['service']}\n"
+                f"💳 {o['pay']}\n"
+                f"📧 {o['email']}\n"
+                f"👤 {o.get('user_name','')}\n"
+                f"📌 {o['status']}\n"
+                f"———"
+            )
+        text = "\n".join(lines)[:3800]
+        kb = admin_orders_kb(orders[0][0], orders[-1][0], has_newer, has_older, st, pay)
+    else:
+        text = TEXT["EN"]["no_orders"]
+        kb = admin_orders_kb(None, None, False, False, st, pay)
+
+    if q.data == "admin_orders":
+        await q.message.reply_text(text, reply_markup=kb)
+    else:
+        try:
+            await q.edit_message_text(text, reply_markup=kb)
+        except TelegramError:
+            pass
+
+SEGMENT_LANGS = {"-": "Any", **{lang: lang for lang in TEXT}}
+SEGMENT_PURCHASED = {"-": "Any", "Y": "Yes", "N": "No"}
+SEGMENT_DAYS = {"0": "Any time", "7": "7 days", "30": "30 days", "90": "90 days"}
+
+def valid_segment(segment: str) -> bool:
+    parts = segment.split(":")
+    return len(parts) == 3 and parts[0] in SEGMENT_LANGS and parts[1] in SEGMENT_PURCHASED \
+        and parts[2] in SEGMENT_DAYS
+
+def segment_label(segment: str) -> str:
+    lang, purchased, days = segment.split(":")
+    return (f"🌐 Language: {SEGMENT_LANGS[lang]} · 🛒 Purchased: {SEGMENT_PURCHASED[purchased]} · "
+            f"🕒 Active: {SEGMENT_DAYS[days]}")
+
+def broadcast_kb(segment: str, n: int):
+    lang, purchased, days = segment.split(":")
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🌐 Language: {SEGMENT_LANGS[lang]}",
+                              callback_data=f"bc:f:{_next_code(SEGMENT_LANGS, lang)}:{purchased}:{days}")],
+        [InlineKeyboardButton(f"🛒 Purchased: {SEGMENT_PURCHASED[purchased]}",
+                              callback_data=f"bc:f:{lang}:{_next_code(SEGMENT_PURCHASED, purchased)}:{days}")],
+        [InlineKeyboardButton(f"🕒 Active: {SEGMENT_DAYS[days]}",
+                              callback_data=f"bc:f:{lang}:{purchased}:{_next_code(SEGMENT_DAYS, days)}")],
+        [InlineKeyboardButton(f"✍️ Write message ({n} users)", callback_data=f"bc:w:{segment}")],
+    ])
 
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # "admin_broadcast" opens the audience picker, "bc:f:<segment>" changes
+    # a filter in place and "bc:w:<segment>" asks for the message
     q = update.callback_query
     await q.answer()
     if not is_admin(q.from_user.id):
         return
-    context.chat_data["broadcast_mode"] = True
-    await q.message.reply_text(TEXT["EN"]["broadcast_prompt"])
+    action, _, segment = q.data.partition(":")[2].partition(":")
+    if action == "w":
+        context.chat_data["broadcast_mode"] = segment
+        await q.message.reply_text(f"{TEXT['EN']['broadcast_prompt']}\n{segment_label(segment)}")
+        return
+
+    segment = segment or SEGMENT_ALL
+    n = await USERS.count(segment)
+    text = f"📢 Broadcast audience: {n} users\n{segment_label(segment)}"
+    if action == "f":
+        try:
+            await q.edit_message_text(text, reply_markup=broadcast_kb(segment, n))
+        except BadRequest:
+            pass  # nothing changed
+    else:
+        await q.message.reply_text(text, reply_markup=broadcast_kb(segment, n))
 
 # ================== USER FLOW ==================
 async def service_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -336,18 +2598,30 @@ async def service_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     lang = get_lang(context)
     key = q.data.split(":")[1]
-    s = SERVICES[key]
+    svc = SERVICES.get(key)
+    if svc is None:  # removed from the catalog since the menu was sent
+        await q.message.reply_text(TEXT[lang]["choose_service"], reply_markup=services_kb())
+        return
+    text = service_text(key, lang)
     context.user_data["service"] = key
+    context.user_data["quote"] = svc  # the price this order is held to
 
     await q.message.reply_text(
-        f"📦 *{s['name']}*\n"
-        f"💵 USDT: {s['usd']} (Best price)\n"
-        f"⭐ Telegram Stars: {s['stars']}\n\n"
-        f"{TEXT[lang]['choose_payment']}",
+        text,
         parse_mode="Markdown",
         reply_markup=pay_kb(lang)
     )
 
+async def services_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # svcp:<page> — flip the services menu in place
+    q = update.callback_query
+    await q.answer()
+    page = min(int(q.data.split(":")[1]), _services_pages(SERVICES) - 1)
+    try:
+        await q.edit_message_reply_markup(reply_markup=services_kb(page))
+    except BadRequest:
+        pass  # the n/N label or the current page clicked: "message is not modified"
+
 async def back_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -361,16 +2635,13 @@ async def back_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = get_lang(context)
 
     key = context.user_data.get("service")
-    if not key:
+    quote = context.user_data.get("quote") or SERVICES.get(key)
+    if not key or not quote:
         await q.message.reply_text(TEXT[lang]["choose_service"], reply_markup=services_kb())
         return
 
-    s = SERVICES[key]
     await q.message.reply_text(
-        f"📦 *{s['name']}*\n"
-        f"💵 USDT: {s['usd']} (Best price)\n"
-        f"⭐ Telegram Stars: {s['stars']}\n\n"
-        f"{TEXT[lang]['choose_payment']}",
+        quote_text(key, quote, lang),
         parse_mode="Markdown",
         reply_markup=pay_kb(lang)
     )
@@ -386,6 +2657,7 @@ async def pay_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["await_img"] = False
     context.user_data["await_email"] = False
     context.user_data.pop("photo", None)
+    context.user_data.pop("photo_uid", None)
 
     await q.message.reply_text(
         TEXT[lang]["usdt_payment"],
@@ -425,8 +2697,9 @@ async def get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
         return
 
-    # ✅ Accept ANY photo (no validation)
+    # ✅ Accept ANY photo; reused screenshots are flagged to the admin
     context.user_data["photo"] = update.message.photo[-1].file_id
+    context.user_data["photo_uid"] = update.message.photo[-1].file_unique_id
     context.user_data["await_img"] = False
     context.user_data["await_email"] = True
 
@@ -439,33 +2712,76 @@ async def pay_stars(update: Update, context: ContextTypes.DEFAULT_TYPE):
     track_user(q.from_user.id)
 
     key = context.user_data.get("service")
-    if not key:
+    svc = context.user_data.get("quote") or SERVICES.get(key)
+    if not key or not svc:
         lang = get_lang(context)
         await q.message.reply_text(TEXT[lang]["choose_service"], reply_markup=services_kb())
         return
 
-    svc = SERVICES[key]
     prices = [LabeledPrice(label=svc["name"], amount=svc["stars"])]
 
     context.user_data["pay"] = "STARS"
+    # nothing to wait for until the invoice is paid (stars_success)
+    context.user_data["await_img"] = False
+    context.user_data["await_email"] = False
+    context.user_data.pop("photo", None)
+    context.user_data.pop("photo_uid", None)
 
     await context.bot.send_invoice(
         chat_id=q.message.chat_id,
         title=svc["name"],
         description="Telegram Stars payment",
-        payload=f"stars:{key}",
+        payload=f"stars:{key}:{svc['stars']}",
         provider_token="",
         currency="XTR",
         prices=prices,
     )
 
+def stars_service(payload: str, currency: str, amount: int):
+    # -> the service key if the invoice is one of ours, else None. The payload
+    # is "stars:<key>:<quoted amount>": an invoice sent before a price change
+    # is honoured at its quoted price. Old "stars:<key>" ones use today's price.
+    kind, key, quoted = (payload.split(":") + [None])[:3]
+    svc = SERVICES.get(key)
+    if kind != "stars" or svc is None or currency != "XTR":
+        return None
+    if amount != (int(quoted) if quoted and quoted.isdigit() else svc["stars"]):
+        return None
+    return key
+
 async def precheckout(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.pre_checkout_query.answer(ok=True)
+    # Must be answered within 10 seconds: no I/O besides the answer itself
+    pcq = update.pre_checkout_query
+    if stars_service(pcq.invoice_payload, pcq.currency, pcq.total_amount):
+        await pcq.answer(ok=True)
+    else:
+        logging.warning("Rejected pre-checkout %r from %s", pcq.invoice_payload, pcq.from_user.id)
+        await pcq.answer(ok=False, error_message=TEXT[get_lang(context)]["pay_invalid"])
 
 async def stars_success(update: Update, context: ContextTypes.DEFAULT_TYPE):
     track_user(update.effective_user.id)
     lang = get_lang(context)
+    sp = update.message.successful_payment
+    key = sp.invoice_payload.split(":")[1] if sp.invoice_payload.count(":") else ""
+    fresh = await PAYMENTS.record(sp.telegram_payment_charge_id, update.effective_user.id, key, sp.total_amount)
+    if not fresh:
+        # Redelivered. If no order was created for it yet (e.g. the process
+        # died before this user's state was saved), ask for the email again.
+        payment = await PAYMENTS.find(sp.telegram_payment_charge_id)
+        if not payment or payment["order_id"] or payment["status"] != "PAID" \
+                or payment["user"] != update.effective_user.id:
+            logging.info("Ignoring repeated payment %s", sp.telegram_payment_charge_id)
+            return
+
+    if key in SERVICES:
+        if context.user_data.get("service") != key:
+            context.user_data["quote"] = SERVICES[key]
+        context.user_data["service"] = key
+    if context.user_data.get("quote"):
+        # what was actually paid
+        context.user_data["quote"] = {**context.user_data["quote"], "stars": sp.total_amount}
     context.user_data["pay"] = "STARS"
+    context.user_data["charge_id"] = sp.telegram_payment_charge_id
     context.user_data["await_email"] = True
     await update.message.reply_text(TEXT[lang]["enter_email"])
 
@@ -483,24 +2799,46 @@ async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     key = context.user_data.get("service")
-    if not key:
+    svc = context.user_data.get("quote") or SERVICES.get(key)
+    if not key or not svc:
         await update.message.reply_text(TEXT[lang]["choose_service"], reply_markup=services_kb())
         return
 
-    svc = SERVICES[key]
     oid = new_order_id()
 
-    ORDERS[oid] = {
+    # a Stars payment pays for exactly one order
+    pay = context.user_data.get("pay", "USDT")
+    charge_id = context.user_data.pop("charge_id", None) if pay == "STARS" else None
+    if pay == "STARS" and not charge_id:
+        # Stars chosen but never paid: no payment to attach the order to
+        context.user_data["await_email"] = False
+        await update.message.reply_text(TEXT[lang]["choose_payment"], reply_markup=pay_kb(lang))
+        return
+    if charge_id and not await PAYMENTS.link(charge_id, oid):
+        context.user_data["await_email"] = False
+        await update.message.reply_text(TEXT[lang]["processing"], reply_markup=support_and_start_kb(lang))
+        return
+
+    order = {
         "user": update.effective_user.id,
         "user_name": update.effective_user.full_name,
         "email": email,
         "service": svc["name"],
-        "pay": context.user_data.get("pay", "USDT"),
-        "photo": context.user_data.get("photo"),
+        "pay": pay,
+        "photo": context.user_data.get("photo") if pay == "USDT" else None,
         "lang": lang,
         "created_at": int(time.time()),
         "status": "WAITING_ADMIN",
+        "price": f"⭐{svc['stars']}" if pay == "STARS" else svc["usd"],
+        "service_key": key,
     }
+    await ORDERS.create(oid, order)
+    ORDER_TIMERS.arm(oid, order["created_at"], pay)
+    USERS.tag(update.effective_user.id, purchased=True)
+    # the screenshot belongs to this order now; a later one must not inherit it
+    context.user_data.pop("photo", None)
+    photo_uid = context.user_data.pop("photo_uid", None)
+    reused = await SHOTS.record(photo_uid, oid) if photo_uid and pay == "USDT" else ()
 
     context.user_data["await_email"] = False
 
@@ -510,30 +2848,67 @@ async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🆕 NEW ORDER\n\n"
         f"🆔 {oid}\n"
         f"📦 {svc['name']}\n"
-        f"💳 {ORDERS[oid]['pay']}\n"
+        f"💳 {order['pay']} — {order['price']}\n"
         f"📧 {email}\n"
         f"👤 {update.effective_user.full_name}\n"
         f"🆔 {update.effective_user.id}"
     )
+    if reused:
+        admin_text += f"\n\n⚠️ Screenshot already used in: {', '.join(reused)}"
+
+    if DIGEST:
+        line = (
+            f"{oid} — {svc['name']} — {order['pay']} {order['price']}\n"
+            f"📧 {email}\n"
+            f"👤 {update.effective_user.full_name} ({update.effective_user.id})"
+        )
+        if reused:
+            line += f"\n⚠️ Screenshot already used in: {', '.join(reused)}"
+        DIGEST.add(oid, line, order.get("photo"))
+    elif order.get("photo"):
+        OUTBOX.submit(
+            "send_photo", PRIO_ORDER, key=f"new:{oid}",
+            chat_id=ADMIN_USER_ID,
+            photo=order["photo"],
+            caption=admin_text,
+            reply_markup=admin_order_kb(oid)
+        )
+    else:
+        OUTBOX.submit(
+            "send_message", PRIO_ORDER, key=f"new:{oid}",
+            chat_id=ADMIN_USER_ID,
+            text=admin_text,
+            reply_markup=admin_order_kb(oid)
+        )
 
-    try:
-        if ORDERS[oid].get("photo"):
-            await context.bot.send_photo(
-                chat_id=ADMIN_USER_ID,
-                photo=ORDERS[oid]["photo"],
-                caption=admin_text,
-                reply_markup=admin_order_kb(oid)
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=admin_text,
-                reply_markup=admin_order_kb(oid)
-            )
-    except Exception as e:
-        logging.exception("Failed to notify admin: %s", e)
+    if photo_uid and order.get("photo"):
+        SHOTS.check_similar(context.bot, photo_uid, oid, order["photo"])
 
 # ================== ADMIN ACTIONS ==================
+def notify_customer(oid: str, user_id: int, lang: str, text_key: str, report: bool = True) -> asyncio.Future:
+    # Queue the customer notification; the admin hears back once it's delivered
+    fut = OUTBOX.submit(
+        "send_message", PRIO_ORDER, key=f"{text_key}:{oid}",
+        chat_id=user_id,
+        text=TEXT[lang][text_key],
+        parse_mode="Markdown",
+        reply_markup=support_and_start_kb(lang)
+    )
+
+    def report_sent(f: asyncio.Future):
+        if f.cancelled():
+            return
+        err = f.exception()
+        OUTBOX.submit(
+            "send_message", PRIO_ADMIN,
+            chat_id=ADMIN_USER_ID,
+            text=TEXT["EN"]["admin_notify_failed"].format(oid=oid, err=str(err)) if err
+            else TEXT["EN"]["admin_notify_sent"].format(oid=oid)
+        )
+    if report:
+        fut.add_done_callback(report_sent)
+    return fut
+
 async def admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -542,52 +2917,22 @@ async def admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     action, oid = q.data.split(":", 1)
-    order = ORDERS.get(oid)
+    order = await ORDERS.get(oid)
     if not order:
-        await q.message.reply_text("❌ Order not found (maybe bot restarted).")
+        await q.message.reply_text("❌ Order not found.")
         return
 
     user_id = order["user"]
     lang = order.get("lang", "EN")
 
     if action == "adm_ok":
-        order["status"] = "CONFIRMED"
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=TEXT[lang]["confirm_text"],
-                parse_mode="Markdown",
-                reply_markup=support_and_start_kb(lang)
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=TEXT["EN"]["admin_notify_sent"].format(oid=oid)
-            )
-        except Exception as e:
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=TEXT["EN"]["admin_notify_failed"].format(oid=oid, err=str(e))
-            )
+        await ORDERS.set_status(oid, "CONFIRMED")
+        notify_customer(oid, user_id, lang, "confirm_text")
         await q.edit_message_text(f"✅ CONFIRMED — {oid}")
 
     elif action == "adm_no":
-        order["status"] = "CANCELLED"
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=TEXT[lang]["cancel_text"],
-                parse_mode="Markdown",
-                reply_markup=support_and_start_kb(lang)
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=TEXT["EN"]["admin_notify_sent"].format(oid=oid)
-            )
-        except Exception as e:
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=TEXT["EN"]["admin_notify_failed"].format(oid=oid, err=str(e))
-            )
+        await ORDERS.set_status(oid, "CANCELLED")
+        notify_customer(oid, user_id, lang, "cancel_text")
         await q.edit_message_text(f"❌ CANCELLED — {oid}")
 
     elif action == "adm_msg":
@@ -595,124 +2940,1077 @@ async def admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.chat_data["msg_order_id"] = oid
         await q.message.reply_text(TEXT["EN"]["msg_prompt"])
 
+def payment_text(p: dict) -> str:
+    return (
+        f"💳 {p['charge_id']}\n"
+        f"📌 {p['status']}\n"
+        f"📦 {p['service']} — ⭐ {p['amount']}\n"
+        f"👤 {p['user']}\n"
+        f"🆔 {p['order_id'] or '—'}\n"
+        f"🕒 {time.strftime('%Y-%m-%d %H:%M', time.gmtime(p['created_at']))} UTC"
+    )
+
+async def admin_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /pay <charge id | order id>
+    if not is_admin(update.effective_user.id):
+        return
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /pay <charge id | order id>")
+        return
+    payment = await PAYMENTS.find(context.args[0])
+    await update.message.reply_text(payment_text(payment) if payment else "❌ Payment not found.")
+
+async def admin_refund(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /refund <charge id | order id>
+    if not is_admin(update.effective_user.id):
+        return
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /refund <charge id | order id>")
+        return
+    payment = await PAYMENTS.find(context.args[0])
+    if not payment:
+        await update.message.reply_text("❌ Payment not found.")
+        return
+    if payment["status"] == "REFUNDED":
+        await update.message.reply_text("Already refunded.\n\n" + payment_text(payment))
+        return
+
+    try:
+        await OUTBOX.submit(
+            "refund_star_payment", PRIO_ADMIN, key=f"refund:{payment['charge_id']}",
+            user_id=payment["user"],
+            telegram_payment_charge_id=payment["charge_id"],
+        )
+    except TelegramError as e:
+        await update.message.reply_text(f"⚠️ Refund failed: {e}")
+        return
+    await PAYMENTS.set_status(payment["charge_id"], "REFUNDED")
+    if payment["order_id"]:
+        await ORDERS.set_status(payment["order_id"], "REFUNDED")
+    await update.message.reply_text("↩️ Refunded.\n\n" + payment_text({**payment, "status": "REFUNDED"}))
+
+# ================== EXPORT ==================
+EXPORT_FETCH = 1000                   # rows per fetchmany()
+EXPORT_MAX_BYTES = 50 * 1024 * 1024   # Bot API upload limit
+EXPORT_USAGE = (
+    "Usage: /export [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] "
+    "[status=W|C|X|R|E] [service=<key>] [pay=USDT|STARS]\n"
+    "status: W waiting, C confirmed, X cancelled, R refunded, E expired"
+)
+EXPORTS = set()  # running export tasks
+
+def _export_day(value: str) -> int:
+    # start of the day, UTC
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+def parse_export_args(args: list) -> tuple:
+    # -> (format, SQL WHERE clause, args); ValueError carries the usage text
+    fmt, where, params = "csv", [], []
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        try:
+            if not sep and arg.lower() in ("csv", "jsonl"):
+                fmt = arg.lower()
+            elif key == "from":
+                where.append("created_at >= ?")
+                params.append(_export_day(value))
+            elif key == "to":
+                where.append("created_at < ?")
+                params.append(_export_day(value) + 86400)
+            elif key == "status":
+                status = ORDER_STATUS_CODES.get(value.upper()) or value.upper()
+                if status not in ORDER_STATUS_CODES.values():
+                    raise ValueError
+                where.append("status = ?")
+                params.append(status)
+            elif key == "service":
+                if not value.isidentifier():
+                    raise ValueError
+                # orders from before service_key existed only have the name; match its current one
+                where.append("(service_key = ? OR (service_key IS NULL AND service = ?))")
+                params += [value, SERVICES[value]["name"] if value in SERVICES else None]
+            elif key == "pay" and value.upper() in ORDER_PAY_CODES.values():
+                where.append("pay = ?")
+                params.append(value.upper())
+            else:
+                raise ValueError
+        except (ValueError, KeyError):
+            raise ValueError(f"❌ Bad filter {arg!r}\n\n{EXPORT_USAGE}") from None
+    return fmt, " AND ".join(where) or "1", params
+
+EXPORT_COLUMNS = ("id", *ORDER_FIELDS)
+
+def export_rows(conn, where: str, params: list):
+    cur = conn.execute(
+        f"SELECT {', '.join(EXPORT_COLUMNS)} FROM orders WHERE {where} ORDER BY id", params
+    )
+    while rows := cur.fetchmany(EXPORT_FETCH):
+        yield from rows
+
+def csv_lines(rows):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(EXPORT_COLUMNS)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        w.writerow(row)
+        yield buf.getvalue()
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+
+def build_export(db: Database, out: str, fmt: str, where: str, params: list) -> int:
+    # rows -> lines -> gzip, one row at a time; runs in a worker thread
+    n = 0
+
+    def counted(rows):
+        nonlocal n
+        for n, row in enumerate(rows, 1):
+            yield row
+
+    conn = db.reader()
+    try:
+        lines = (csv_lines if fmt == "csv" else jsonl_lines)(counted(export_rows(conn, where, params)))
+        with gzip.open(out, "wt", encoding="utf-8", newline="") as f:
+            f.writelines(lines)
+    finally:
+        conn.close()
+    return n
+
+async def run_export(chat_id: int, fmt: str, where: str, params: list):
+    fd, out = tempfile.mkstemp(prefix="orders-", suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        t = time.monotonic()
+        n = await asyncio.to_thread(build_export, DB, out, fmt, where, params)
+        size = os.path.getsize(out)
+        if not n:
+            text = "📦 No orders match."
+        elif size > EXPORT_MAX_BYTES:
+            text = f"⚠️ Export is {size // (1024 * 1024)} MB, over the 50 MB upload limit. Narrow the filters."
+        else:
+            await OUTBOX.submit(
+                "send_document", PRIO_ADMIN,
+                chat_id=chat_id,
+                document=Path(out),
+                filename=f"orders-{time.strftime('%Y%m%d-%H%M')}.{fmt}.gz",
+                caption=f"📤 {n} orders ({fmt.upper()}, gzip) in {time.monotonic() - t:.1f}s",
+            )
+            return
+        OUTBOX.submit("send_message", PRIO_ADMIN, chat_id=chat_id, text=text)
+    except Exception as e:
+        logging.exception("Export failed: %s", e)
+        OUTBOX.submit("send_message", PRIO_ADMIN, chat_id=chat_id, text=f"⚠️ Export failed: {e}")
+    finally:
+        os.unlink(out)
+
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /export [csv|jsonl] [filters...] — built in the background, sent as a document
+    if not is_admin(update.effective_user.id):
+        return
+    try:
+        fmt, where, params = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text("⏳ Building export…")
+    task = asyncio.create_task(run_export(update.effective_chat.id, fmt, where, params))
+    EXPORTS.add(task)
+    task.add_done_callback(EXPORTS.discard)
+
+# ================== ADMIN DIGEST ==================
+ADMIN_DIGEST = float(os.getenv("ADMIN_DIGEST", 0))  # seconds to collect new orders; 0 = one message per order
+DIGEST_MAX = 10  # a media group holds at most 10 photos
+
+class OrderDigest:
+    # Collects new orders for ADMIN_DIGEST seconds and sends them to the admin
+    # as one album of screenshots plus one summary with bulk actions, instead
+    # of a message per order and three more per Confirm/Cancel. The summary
+    # (orders and which are selected, as a bitmask) lives in `digests`, so its
+    # buttons keep working after a restart and on any worker. Orders still
+    # buffered at a crash stay WAITING_ADMIN and show up in 📦 Orders.
+
+    def __init__(self, db: Database, window: float = ADMIN_DIGEST):
+        self.db = db
+        self.window = window
+        self._pending = []  # (oid, summary line, photo file_id)
+        self._timer = None
+        self._tasks = set()
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS digests (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                orders     TEXT NOT NULL,
+                lines      TEXT NOT NULL,
+                selected   INTEGER NOT NULL,
+                done       INTEGER NOT NULL DEFAULT 0,
+                created_at INTEGER NOT NULL
+            );
+        """)
+
+    def add(self, oid: str, line: str, photo: str = None):
+        self._pending.append((oid, line, photo))
+        if len(self._pending) >= DIGEST_MAX:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        self.flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def get(self, did: int):
+        def q(conn):
+            return conn.execute("SELECT * FROM digests WHERE id = ?", (did,)).fetchone()
+        row = await self.db.run(q)
+        if not row:
+            return None
+        # lines are JSON: a summary line may itself contain newlines
+        lines = json.loads(row["lines"]) if row["lines"].startswith("[") else row["lines"].split("\n")
+        return {**dict(row), "orders": row["orders"].split(","), "lines": lines}
+
+    async def toggle(self, did: int, idx: int):
+        def q(conn):
+            with conn:
+                # no XOR in SQLite: (a | b) - (a & b)
+                conn.execute(
+                    "UPDATE digests SET selected = (selected | ?) - (selected & ?) WHERE id = ? AND done = 0",
+                    (1 << idx, 1 << idx, did),
+                )
+        await self.db.run(q)
+
+    async def claim(self, did: int) -> bool:
+        # exactly one bulk action per digest, however often it is clicked
+        def q(conn):
+            with conn:
+                return conn.execute("UPDATE digests SET done = 1 WHERE id = ? AND done = 0", (did,)).rowcount > 0
+        return await self.db.run(q)
+
+    async def _send(self, batch: list):
+        oids = [oid for oid, _, _ in batch]
+        lines = [f"{i}. {line}" for i, (_, line, _) in enumerate(batch, 1)]
+
+        def q(conn):
+            with conn:
+                return conn.execute(
+                    "INSERT INTO digests (orders, lines, selected, created_at) VALUES (?, ?, ?, ?)",
+                    (",".join(oids), json.dumps(lines, ensure_ascii=False), (1 << len(oids)) - 1, int(time.time())),
+                ).lastrowid
+        try:
+            did = await self.db.run(q)
+        except Exception as e:
+            logging.exception("Failed to store order digest: %s", e)
+            return
+
+        media = [InputMediaPhoto(photo, caption=f"{i}. {oid}")
+                 for i, (oid, _, photo) in enumerate(batch, 1) if photo]
+        if len(media) > 1:
+            OUTBOX.submit("send_media_group", PRIO_ORDER, key=f"digest:{did}:album",
+                          chat_id=ADMIN_USER_ID, media=media)
+        elif media:
+            OUTBOX.submit("send_photo", PRIO_ORDER, key=f"digest:{did}:album",
+                          chat_id=ADMIN_USER_ID, photo=media[0].media, caption=media[0].caption)
+        digest = {"id": did, "orders": oids, "lines": lines, "selected": (1 << len(oids)) - 1}
+        OUTBOX.submit("send_message", PRIO_ORDER, key=f"digest:{did}", chat_id=ADMIN_USER_ID,
+                      text=digest_text(digest), reply_markup=digest_kb(digest))
+
+def digest_text(digest: dict) -> str:
+    return f"🆕 {len(digest['orders'])} NEW ORDERS\n\n" + "\n\n".join(digest["lines"])
+
+def digest_kb(digest: dict, done: bool = False):
+    # per order: select toggle and 💬 Message Customer; once a bulk action ran, only 💬
+    did, sel = digest["id"], digest["selected"]
+    if done:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"💬 {i + 1}. {oid}", callback_data=f"adm_msg:{oid}")]
+            for i, oid in enumerate(digest["orders"])
+        ])
+    rows = [
+        [
+            InlineKeyboardButton(f"{'✅' if sel >> i & 1 else '⬜'} {i + 1}. {oid}", callback_data=f"dg:t:{did}:{i}"),
+            InlineKeyboardButton("💬", callback_data=f"adm_msg:{oid}"),
+        ]
+        for i, oid in enumerate(digest["orders"])
+    ]
+    rows.append([InlineKeyboardButton("✅ Confirm all", callback_data=f"dg:all:{did}")])
+    rows.append([
+        InlineKeyboardButton("✔️ Confirm selected", callback_data=f"dg:ok:{did}"),
+        InlineKeyboardButton("❌ Cancel selected", callback_data=f"dg:no:{did}"),
+    ])
+    return InlineKeyboardMarkup(rows)
+
+DIGEST = OrderDigest(DB) if ADMIN_DIGEST > 0 else None
+
+async def admin_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer()
+        return
+
+    _, action, rest = q.data.split(":", 2)
+    did, _, idx = rest.partition(":")
+    digest = await DIGEST.get(int(did)) if DIGEST else None
+    if not digest or digest["done"]:
+        await q.answer("Already handled.")
+        return
+
+    if action == "t":
+        if int(idx) >= len(digest["orders"]):
+            await q.answer()
+            return
+        await DIGEST.toggle(digest["id"], int(idx))
+        digest["selected"] ^= 1 << int(idx)
+        await q.answer()
+        await q.edit_message_reply_markup(reply_markup=digest_kb(digest))
+        return
+
+    sel = (1 << len(digest["orders"])) - 1 if action == "all" else digest["selected"]
+    chosen = [oid for i, oid in enumerate(digest["orders"]) if sel >> i & 1]
+    if not chosen or not await DIGEST.claim(digest["id"]):
+        await q.answer("Nothing selected." if not chosen else "Already handled.")
+        return
+
+    status, text_key = ("CANCELLED", "cancel_text") if action == "no" else ("CONFIRMED", "confirm_text")
+    orders = await ORDERS.set_status_many(chosen, status)
+    await q.answer(f"{status.title()} {len(orders)} orders")
+
+    # one customer message per order, one summary edit for all of them
+    futs = [notify_customer(o["id"], o["user"], o.get("lang") or "EN", text_key, report=False) for o in orders]
+    header = f"{'✅' if status == 'CONFIRMED' else '❌'} {status} {len(orders)}/{len(digest['orders'])}"
+    chat_id, message_id = q.message.chat_id, q.message.message_id
+
+    def report(f: asyncio.Future):
+        failed = [f"{o['id']} ({r})" for o, r in zip(orders, f.result()) if isinstance(r, BaseException)]
+        text = f"{header} — {len(orders) - len(failed)} customers notified"
+        if failed:
+            text += "\n⚠️ Not notified: " + ", ".join(failed)
+        OUTBOX.submit("edit_message_text", PRIO_ADMIN, chat_id=chat_id, message_id=message_id,
+                      text=f"{text}\n\n" + "\n\n".join(digest["lines"]), reply_markup=digest_kb(digest, done=True))
+    asyncio.gather(*futs, return_exceptions=True).add_done_callback(report)
+
 # ================== ADMIN TEXT HANDLER (priority) ==================
 async def admin_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
 
-    # Broadcast mode
-    if context.chat_data.get("broadcast_mode"):
-        msg = update.message.text
-        sent, failed = 0, 0
-        for uid in list(USERS):
-            try:
-                await context.bot.send_message(chat_id=uid, text=msg)
-                sent += 1
-                await asyncio.sleep(0.03)
-            except Exception:
-                failed += 1
-
-        context.chat_data.pop("broadcast_mode", None)
-        await update.message.reply_text(TEXT["EN"]["broadcast_done"].format(sent=sent, failed=failed))
+    # Broadcast mode (runs in the background)
+    segment = context.chat_data.pop("broadcast_mode", None)
+    if segment:
+        # older states stored True: everyone
+        segment = segment if isinstance(segment, str) and valid_segment(segment) else SEGMENT_ALL
+        if not await BROADCASTS.start(update.message.text, update.effective_chat.id, segment):
+            await update.message.reply_text(TEXT["EN"]["broadcast_busy"])
         return
 
     # Message customer mode
     target = context.chat_data.get("msg_target")
     oid = context.chat_data.get("msg_order_id")
     if target and oid:
-        try:
-            await context.bot.send_message(
-                chat_id=target,
-                text=update.message.text,
-                reply_markup=support_kb()
-            )
-            await update.message.reply_text(TEXT["EN"]["msg_sent"])
-            await context.bot.send_message(
+        fut = OUTBOX.submit(
+            "send_message", PRIO_ADMIN,
+            chat_id=target,
+            text=update.message.text,
+            reply_markup=support_kb()
+        )
+
+        def report(f: asyncio.Future):
+            if f.cancelled():
+                return
+            err = f.exception()
+            OUTBOX.submit(
+                "send_message", PRIO_ADMIN,
                 chat_id=ADMIN_USER_ID,
-                text=f"📨 Message delivered to customer (Order {oid})."
+                text=f"⚠️ Failed to send: {err}" if err
+                else f"{TEXT['EN']['msg_sent']}\n📨 Order {oid}."
             )
-        except Exception as e:
-            await update.message.reply_text(f"⚠️ Failed to send: {e}")
+        fut.add_done_callback(report)
 
         context.chat_data.pop("msg_target", None)
         context.chat_data.pop("msg_order_id", None)
         return
 
-# ================== APP ==================
-def build():
-    app = Application.builder().token(BOT_TOKEN).build()
+# ================== TIMERS ==================
+TIMER_TICK = 1.0       # seconds per wheel slot
+TIMER_SLOTS = 512      # one turn of the wheel = 512 ticks
+TIMER_BATCH = 60       # seconds to gather due orders into one admin message
+ORDER_REMIND = float(os.getenv("ORDER_REMIND", 1800))         # remind the admin about orders waiting this long
+ORDER_EXPIRE = float(os.getenv("ORDER_EXPIRE", 72 * 3600))    # expire unconfirmed USDT orders (0 = never)
+NUDGE_AFTER = float(os.getenv("NUDGE_AFTER", 1800))           # nudge customers stalled at screenshot/email
+STATE_IDLE = float(os.getenv("STATE_IDLE", 24 * 3600))        # drop conversation state idle this long
+ADMIN_MODE_TIMEOUT = float(os.getenv("ADMIN_MODE_TIMEOUT", 600))  # broadcast / message-customer mode
+
+class TimerWheel:
+    # Hashed timing wheel. A timer goes into slot (due tick % SLOTS) under its
+    # key; every tick visits one slot and fires what is due there. schedule()
+    # replaces a timer with the same key and cancel() removes it, both O(1),
+    # so re-arming a per-user timer on every update is cheap and tens of
+    # thousands of pending timers cost nothing while they wait. Callbacks may
+    # be plain functions or coroutine functions.
+
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick, self.slots = tick, slots
+        self.app = None
+        self._wheel = [{} for _ in range(slots)]
+        self._where = {}  # key -> slot
+        self._now = 0     # ticks since start
+        self._task = None
+        self._tasks = set()
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key) -> bool:
+        return key in self._where
+
+    def schedule(self, key, delay: float, fn, *args):
+        self.cancel(key)
+        due = self._now + max(1, math.ceil(delay / self.tick))
+        slot = due % self.slots
+        self._wheel[slot][key] = (due, fn, args)
+        self._where[key] = slot
+
+    def cancel(self, key) -> bool:
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._wheel[slot][key]
+        return True
+
+    def _advance(self):
+        self._now += 1
+        bucket = self._wheel[self._now % self.slots]
+        for key in [k for k, (due, _, _) in bucket.items() if due <= self._now]:
+            _, fn, args = bucket.pop(key)
+            del self._where[key]
+            try:
+                res = fn(*args)
+                if asyncio.iscoroutine(res):
+                    task = asyncio.create_task(res)
+                    self._tasks.add(task)
+                    task.add_done_callback(self._done)
+            except Exception as e:
+                logging.exception("Timer %r failed: %s", key, e)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error("Timer task failed: %s", task.exception())
+
+    async def _run(self):
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(max(0.0, start + (self._now + 1) * self.tick - time.monotonic()))
+            # catch up if the loop was late
+            while start + (self._now + 1) * self.tick <= time.monotonic():
+                self._advance()
+
+    def start(self, app: Application):
+        self.app = app
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, *self._tasks) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+TIMERS = TimerWheel()
+
+# ---------- orders: admin reminders, USDT expiry ----------
+TIMER_LEASE = 60  # shared mode: seconds before another worker may take over the order timers
+
+class OrderTimers:
+    # Every WAITING_ADMIN order has a reminder timer and, for USDT, an expiry
+    # timer. Timers are not cancelled when the admin acts; whatever comes due
+    # is checked against the order's status at that point. Due orders are
+    # gathered for TIMER_BATCH seconds and reported in one admin message.
+    #
+    # With several workers (shared=True) only the one holding the `orders`
+    # lease runs them: it renews the lease every TIMER_LEASE / 3 seconds and
+    # then arms the orders any worker created since, so the admin hears
+    # about each order once.
+
+    def __init__(self, wheel: TimerWheel, db: Database, shared: bool = False):
+        self.wheel = wheel
+        self.db = db
+        self.shared = shared
+        self.leader = not shared
+        self.owner = os.getpid()
+        self._since = 0  # created_at of the newest order armed
+        self._due = {"remind": set(), "expire": set()}
+        db.run_sync(self._init)
+
+    @staticmethod
+    def _init(conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name      TEXT PRIMARY KEY,
+                owner     INTEGER NOT NULL,
+                heartbeat INTEGER NOT NULL
+            );
+        """)
+
+    def arm(self, oid: str, created_at: int, pay: str, now: float = None):
+        if not self.leader:
+            return
+        age = (now or time.time()) - created_at
+        self._since = max(self._since, created_at)
+        self.wheel.schedule(("remind", oid), ORDER_REMIND - age, self._fire, "remind", oid)
+        if pay == "USDT" and ORDER_EXPIRE:
+            self.wheel.schedule(("expire", oid), ORDER_EXPIRE - age, self._fire, "expire", oid)
+
+    def _fire(self, kind: str, oid: str):
+        self._due[kind].add(oid)
+        if ("orders", "flush") not in self.wheel:
+            self.wheel.schedule(("orders", "flush"), TIMER_BATCH, self._flush)
+
+    async def _flush(self):
+        due, self._due = self._due, {"remind": set(), "expire": set()}
+        if not self.leader:
+            return
+        expired, waiting = [], []
+        ids = sorted(due["expire"])
+        for i in range(0, len(ids), 500):
+            expired += await ORDERS.set_status_many(ids[i:i + 500], "EXPIRED")
+        for o in expired:
+            notify_customer(o["id"], o["user"], o.get("lang") or "EN", "expired_text", report=False)
+        ids = sorted(due["remind"] - {o["id"] for o in expired})
+        for i in range(0, len(ids), 500):
+            waiting += await ORDERS.waiting(ids[i:i + 500])
+        for oid in waiting:
+            self.wheel.schedule(("remind", oid), ORDER_REMIND, self._fire, "remind", oid)
+
+        parts = []
+        if waiting:
+            parts.append(f"⏰ {len(waiting)} orders waiting over {ORDER_REMIND / 60:.0f} min:\n" + _id_list(waiting))
+        if expired:
+            parts.append(f"⌛ Expired {len(expired)} unconfirmed USDT orders:\n" + _id_list([o["id"] for o in expired]))
+        if parts:
+            OUTBOX.submit("send_message", PRIO_ADMIN, chat_id=ADMIN_USER_ID, text="\n\n".join(parts))
+
+    async def rearm(self, since: int = 0) -> int:
+        # arm the waiting orders created at or after `since`
+        def q(conn):
+            return conn.execute(
+                "SELECT id, created_at, pay FROM orders WHERE status = 'WAITING_ADMIN' AND created_at >= ?", (since,)
+            ).fetchall()
+        now = time.time()
+        rows = await self.db.run(q)
+        for oid, created_at, pay in rows:
+            self.arm(oid, created_at, pay, now)
+        return len(rows)
+
+    def _claim(self, conn) -> bool:
+        now = int(time.time())
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO leases (name, owner, heartbeat) VALUES ('orders', ?, ?)",
+                         (self.owner, now))
+            return conn.execute(
+                "UPDATE leases SET owner = ?, heartbeat = ? WHERE name = 'orders' AND (owner = ? OR heartbeat < ?)",
+                (self.owner, now, self.owner, now - TIMER_LEASE),
+            ).rowcount > 0
+
+    async def _lead(self):
+        try:
+            was_leader, self.leader = self.leader, await self.db.run(self._claim)
+            if self.leader:
+                # everything on taking over, then what other workers created since
+                await self.rearm(self._since if was_leader else 0)
+        finally:
+            self.wheel.schedule(("orders", "lease"), TIMER_LEASE / 3, self._lead)
+
+    async def start(self):
+        if self.shared:
+            self.leader = False
+            await self._lead()
+        else:
+            await self.rearm()
+
+def _id_list(ids: list, limit: int = 30) -> str:
+    more = f"\n…and {len(ids) - limit} more" if len(ids) > limit else ""
+    return "\n".join(ids[:limit]) + more
+
+ORDER_TIMERS = OrderTimers(TIMERS, DB, shared=BACKEND.shared)
+
+# ---------- conversation state: nudges, idle eviction, admin modes ----------
+ADMIN_MODES = ("broadcast_mode", "msg_target")
+
+def nudge_user(uid: int, snapshot: dict = None):
+    data = TIMERS.app.user_data.get(uid, snapshot) or {}
+    key = "nudge_img" if data.get("await_img") else "nudge_email" if data.get("await_email") else None
+    if key:
+        lang = data.get("lang") or "EN"
+        OUTBOX.submit("send_message", PRIO_BULK, chat_id=uid, text=TEXT[lang][key])
+
+def evict_user(uid: int):
+    # Free the in-memory copy only: the saved row (lang, a paid charge_id...)
+    # stays and is read back on the user's next update. PTB has no public
+    # call for that; drop_user_data() would delete the row too.
+    TIMERS.cancel(("nudge", uid))
+    app = TIMERS.app
+    data = app._user_data.pop(uid, None)
+    if data is None:
+        return
+    unsaved = uid in app._user_ids_to_be_updated_in_persistence
+    app._user_ids_to_be_updated_in_persistence.discard(uid)
+    BACKEND.persistence.evict("user", uid, data if unsaved else None)
+
+async def expire_admin_mode(chat_id: int, snapshot: dict = None):
+    app = TIMERS.app
+    if BACKEND.shared:
+        # another worker may have used the chat since: only clear modes
+        # nobody has touched for the whole timeout
+        def q(conn):
+            with conn:
+                row = conn.execute(
+                    "SELECT broadcast_mode, msg_target FROM chat_state WHERE chat_id = ? AND updated_at <= ?",
+                    (chat_id, int(time.time() - ADMIN_MODE_TIMEOUT)),
+                ).fetchone()
+                if row:
+                    conn.execute("DELETE FROM chat_state WHERE chat_id = ?", (chat_id,))
+            return row
+        row = await DB.run(q)
+        active = row is not None and any(row)
+    else:
+        data = app.chat_data.get(chat_id, snapshot) or {}
+        active = any(data.get(k) for k in ADMIN_MODES)
+    if active:
+        OUTBOX.submit("send_message", PRIO_ADMIN, chat_id=chat_id,
+                      text="⌛ Broadcast / message mode timed out. Start again from /admin.")
+    app.drop_chat_data(chat_id)
+
+async def touch_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Last handler group: (re)arm this user's and chat's state timers
+    user, chat = update.effective_user, update.effective_chat
+    if user:
+        TIMERS.schedule(("idle", user.id), STATE_IDLE, evict_user, user.id)
+        ud = context.user_data
+        if ud.get("await_img") or ud.get("await_email"):
+            TIMERS.schedule(("nudge", user.id), NUDGE_AFTER, nudge_user, user.id)
+        else:
+            TIMERS.cancel(("nudge", user.id))
+    if chat:
+        if any(context.chat_data.get(k) for k in ADMIN_MODES):
+            TIMERS.schedule(("mode", chat.id), ADMIN_MODE_TIMEOUT, expire_admin_mode, chat.id)
+        else:
+            TIMERS.cancel(("mode", chat.id))
+
+async def rearm_state_timers():
+    # After a restart: nudges still due and admin modes still on. Idle
+    # eviction needs no timer until a user's state is loaded again.
+    def q(conn):
+        users = conn.execute(
+            "SELECT user_id, lang, flags, updated_at FROM user_state WHERE flags != 0 AND updated_at > ?",
+            (int(time.time() - NUDGE_AFTER),),
+        ).fetchall()
+        chats = conn.execute(
+            "SELECT chat_id, broadcast_mode, msg_target, updated_at FROM chat_state "
+            "WHERE broadcast_mode IS NOT NULL OR msg_target IS NOT NULL"
+        ).fetchall()
+        return users, chats
+    users, chats = await DB.run(q)
+    now = time.time()
+    for uid, lang, flags, updated_at in users:
+        snapshot = {"lang": lang, "await_img": bool(flags & FlowState.AWAIT_IMG),
+                    "await_email": bool(flags & FlowState.AWAIT_EMAIL)}
+        TIMERS.schedule(("nudge", uid), NUDGE_AFTER - (now - updated_at), nudge_user, uid, snapshot)
+    for chat_id, broadcast_mode, msg_target, updated_at in chats:
+        snapshot = {"broadcast_mode": broadcast_mode, "msg_target": msg_target}
+        TIMERS.schedule(("mode", chat_id), ADMIN_MODE_TIMEOUT - (now - (updated_at or 0)), expire_admin_mode,
+                        chat_id, snapshot)
+
+# ================== FLOOD GUARD ==================
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 1))    # sustained updates per second per user
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 8))  # updates a user may send at once
+FLOOD_DROPPED = Counter("bot_flood_dropped_total", "Updates dropped by the flood guard, by kind", ("kind",))
+METRICS.append(FLOOD_DROPPED)
+
+class FloodGuard:
+    # One token bucket per user: {uid: [tokens, last refill]}, kept in
+    # last-seen order. A bucket idle long enough to be full again is the same
+    # as no bucket, so those are dropped from the old end as we go and the
+    # map only holds users active in the last burst/rate seconds.
+
+    def __init__(self, rate: float = FLOOD_RATE, burst: float = FLOOD_BURST):
+        self.rate, self.burst = rate, burst
+        self.idle = burst / rate
+        self._buckets: OrderedDict[int, list] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, uid: int) -> bool:
+        now = time.monotonic()
+        b = self._buckets.get(uid)
+        if b is None:
+            b = self._buckets[uid] = [self.burst, now]
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            self._buckets.move_to_end(uid)
+        while True:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest[1] < self.idle:
+                break
+            self._buckets.popitem(last=False)
+        if b[0] < 1:
+            return False
+        b[0] -= 1
+        return True
+
+FLOOD = FloodGuard()
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Handler group -1: runs before every other handler. Excess updates are
+    # dropped (callbacks just get their spinner stopped) and stop dispatch.
+    user = update.effective_user
+    if user is None or is_admin(user.id) or update.pre_checkout_query:
+        return
+    if update.message and update.message.successful_payment:
+        return  # never drop a payment
+    if FLOOD.allow(user.id):
+        return
+    if update.callback_query:
+        FLOOD_DROPPED.inc("callback")
+        await update.callback_query.answer()
+    else:
+        FLOOD_DROPPED.inc("message")
+    raise ApplicationHandlerStop
+
+# ================== CALLBACK ROUTER ==================
+# callback_data is "<prefix>" or "<prefix>:<arg>". A single CallbackQueryHandler
+# looks the prefix up here and checks the arg before calling the handler:
+# a validator of None means the button takes no arg.
+def _valid_oid(arg: str) -> bool:
+    return 0 < len(arg) <= 32 and arg.isalnum()
+
+_DIGEST_ARG = re.compile(r"(?:t:\d{1,12}:\d|all:\d{1,12}|ok:\d{1,12}|no:\d{1,12})")
+
+CALLBACK_ROUTES = {
+    "start_again":     (start_again, None),
+    "lang":            (set_language, lambda a: a in TEXT),
+    # admin panel
+    "admin_users":     (admin_users, None),
+    "admin_orders":    (admin_orders, None),
+    "admin_stats":     (admin_stats, None),
+    "st":              (admin_stats, lambda a: a.isdigit() and int(a) in STATS_WINDOWS),
+    "ao":              (admin_orders, lambda a: a.count(":") == 3),
+    "admin_broadcast": (admin_broadcast, None),
+    "bc":              (admin_broadcast, lambda a: a[:2] in ("f:", "w:") and valid_segment(a[2:])),
+    # user flow
+    # any valid key (see load_services): service_select answers a removed one itself
+    "svc":             (service_select, lambda a: a.isidentifier() and len(a) <= 32),
+    "svcp":            (services_page, lambda a: a.isdigit() and len(a) <= 4),
+    "back_services":   (back_services, None),
+    "back_payment":    (back_payment, None),
+    "pay_usdt":        (pay_usdt, None),
+    "copy":            (copy_addr, None),
+    "send_addr":       (send_addr, None),
+    "paid":            (paid_usdt, None),
+    "pay_stars":       (pay_stars, None),
+    # admin order actions
+    "adm_ok":          (admin_actions, _valid_oid),
+    "adm_no":          (admin_actions, _valid_oid),
+    "adm_msg":         (admin_actions, _valid_oid),
+    "dg":              (admin_digest, _DIGEST_ARG.fullmatch),
+}
 
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("admin", admin_panel))
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    prefix, _, arg = (q.data or "").partition(":")
+    route = CALLBACK_ROUTES.get(prefix)
+    if route is None:
+        await q.answer()
+        return
+    handler, valid = route
+    if not (valid(arg) if valid else not arg):
+        logging.warning("Rejected callback data %r from %s", q.data, q.from_user.id)
+        await q.answer()
+        return
+    await timed(handler, update, context)
+
+# ================== UPDATE PROCESSING ==================
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 64))
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats run concurrently (up to the limit), while
+    # updates from one chat run one at a time in arrival order, so a user's
+    # user_data state machine never sees its updates reordered. The fetcher
+    # starts tasks in arrival order and asyncio.Lock is FIFO, so taking the
+    # chat lock before anything else awaits preserves that order.
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # key -> [asyncio.Lock, number of queued updates]
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        if isinstance(update, Update) and update.pre_checkout_query:
+            # skip the queue for free slots as well: answering late fails the payment
+            await coroutine
+            return
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
 
-    # Start again
-    app.add_handler(CallbackQueryHandler(start_again, pattern=r"^start_again$"))
+    async def do_process_update(self, update, coroutine):
+        await coroutine
 
-    # Language
-    app.add_handler(CallbackQueryHandler(set_language, pattern=r"^lang:"))
+    async def initialize(self):
+        pass
 
-    # Admin panel buttons
-    app.add_handler(CallbackQueryHandler(admin_users, pattern=r"^admin_users$"))
-    app.add_handler(CallbackQueryHandler(admin_orders, pattern=r"^admin_orders$"))
-    app.add_handler(CallbackQueryHandler(admin_broadcast, pattern=r"^admin_broadcast$"))
+    async def shutdown(self):
+        pass
 
-    # User flow
-    app.add_handler(CallbackQueryHandler(service_select, pattern=r"^svc:"))
-    app.add_handler(CallbackQueryHandler(back_services, pattern=r"^back_services$"))
-    app.add_handler(CallbackQueryHandler(back_payment, pattern=r"^back_payment$"))
+# ================== APP ==================
+def build():
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .request(MetricsRequest(connection_pool_size=256))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(BACKEND.persistence)
+        .build()
+    )
 
-    # USDT
-    app.add_handler(CallbackQueryHandler(pay_usdt, pattern=r"^pay_usdt$"))
-    app.add_handler(CallbackQueryHandler(copy_addr, pattern=r"^copy$"))
-    app.add_handler(CallbackQueryHandler(send_addr, pattern=r"^send_addr$"))
-    app.add_handler(CallbackQueryHandler(paid_usdt, pattern=r"^paid$"))
-    app.add_handler(MessageHandler(filters.PHOTO, get_photo))
+    # Flood guard before everything else
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
 
-    # Stars
-    app.add_handler(CallbackQueryHandler(pay_stars, pattern=r"^pay_stars$"))
-    app.add_handler(PreCheckoutQueryHandler(precheckout))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, stars_success))
+    # Commands
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("admin", instrumented(admin_panel)))
+    app.add_handler(CommandHandler("pay", instrumented(admin_payment)))
+    app.add_handler(CommandHandler("refund", instrumented(admin_refund)))
+    app.add_handler(CommandHandler("export", instrumented(admin_export)))
+    app.add_handler(CommandHandler("stats", instrumented(admin_stats)))
+
+    # All inline buttons (see CALLBACK_ROUTES)
+    app.add_handler(CallbackQueryHandler(route_callback))
+
+    # USDT screenshot
+    app.add_handler(MessageHandler(filters.PHOTO, instrumented(get_photo)))
 
-    # Admin callbacks
-    app.add_handler(CallbackQueryHandler(admin_actions, pattern=r"^adm_"))
+    # Stars
+    app.add_handler(PreCheckoutQueryHandler(instrumented(precheckout)))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, instrumented(stars_success)))
 
     # Admin text handler must run BEFORE email handler
     app.add_handler(
-        MessageHandler(filters.User(ADMIN_USER_ID) & filters.TEXT & ~filters.COMMAND, admin_text_handler),
+        MessageHandler(filters.User(ADMIN_USER_ID) & filters.TEXT & ~filters.COMMAND, instrumented(admin_text_handler)),
         group=0
     )
 
     # Email handler for everyone
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, get_email), group=1)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(get_email)), group=1)
+
+    # Re-arm state timers (nudges, idle eviction, admin mode timeouts)
+    app.add_handler(TypeHandler(Update, touch_state), group=99)
+
+    # Shared state: persist each update's user/chat state before the next one
+    if BACKEND.shared:
+        app.add_handler(TypeHandler(Update, write_through_state), group=100)
 
     return app
 
-# ================== HEALTH SERVER (Render) ==================
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"OK")
+# ================== HTTP SERVER (health + webhook) ==================
+# One asyncio server on PORT answers the host's health checks and, in webhook
+# mode, receives updates from Telegram. A recorded update can be replayed with
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json http://localhost:$PORT/telegram
+HTTP_MAX_BODY = 1 << 20
+HTTP_IDLE_TIMEOUT = 30
+HTTP_STATUS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+    503: "Service Unavailable",
+}
 
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
+async def health_route(app: Application, headers: dict, body: bytes):
+    _, worst = MONITOR.lag()
+    if worst >= LOOP_DEGRADED:
+        return 503, "text/plain", f"DEGRADED: event loop lag {worst:.2f}s".encode()
+    return 200, "text/plain", b"OK"
 
-def run_http_server():
-    HTTPServer(("0.0.0.0", PORT), HealthHandler).serve_forever()
+async def loop_route(app: Application, headers: dict, body: bytes):
+    return 200, "application/json", json.dumps(MONITOR.snapshot(), indent=1).encode()
 
-# ================== MAIN ==================
-if __name__ == "__main__":
-    # Start health server for Render
-    threading.Thread(target=run_http_server, daemon=True).start()
+async def metrics_route(app: Application, headers: dict, body: bytes):
+    return 200, "text/plain; version=0.0.4", (await render_metrics()).encode()
 
-    app = build()
+async def webhook_route(app: Application, headers: dict, body: bytes):
+    token = headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return 403, "text/plain", b"Forbidden"
+    try:
+        update = Update.de_json(json.loads(body), app.bot)
+    except Exception:
+        return 400, "text/plain", b"Bad Request"
+    await app.update_queue.put(update)
+    return 200, "text/plain", b"OK"
+
+HTTP_ROUTES = {
+    ("GET", "/"): health_route,
+    ("GET", "/health"): health_route,
+    ("GET", "/metrics"): metrics_route,
+    ("GET", "/debug/loop"): loop_route,
+}
+
+async def _http_request(reader: asyncio.StreamReader):
+    line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY:
+        return method, target, headers, None
+    body = await asyncio.wait_for(reader.readexactly(length), HTTP_IDLE_TIMEOUT) if length else b""
+    return method, target, headers, body
+
+async def _http_conn(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            req = await _http_request(reader)
+            if req is None:
+                break
+            method, target, headers, body = req
+            path = target.split("?", 1)[0]
+            route = HTTP_ROUTES.get(("GET" if method == "HEAD" else method, path))
+            if body is None:
+                status, ctype, payload = 413, "text/plain", b"Payload Too Large"
+            elif route is None:
+                status, ctype, payload = 404, "text/plain", b"Not Found"
+            else:
+                status, ctype, payload = await route(app, headers, body)
+
+            keep_alive = body is not None and headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\n"
+                f"Content-Type: {ctype}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                + (b"" if method == "HEAD" else payload)
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logging.exception("HTTP handler failed: %s", e)
+    finally:
+        writer.close()
+
+async def start_http_server(app: Application):
+    return await asyncio.start_server(lambda r, w: _http_conn(app, r, w), "0.0.0.0", PORT)
 
-    async def on_startup(application: Application):
-        # Ensure no webhook & drop old updates to avoid getUpdates conflict
-        await application.bot.delete_webhook(drop_pending_updates=True)
+# ================== MAIN ==================
+async def on_startup(application: Application):
+    MONITOR.start()
+    CATALOG.start()
+    TIMERS.start(application)
+    await ORDER_TIMERS.start()
+    await rearm_state_timers()
+    USERS.start()
+    OUTBOX.start(application.bot)
+    await BROADCASTS.resume()
+
+async def on_shutdown(application: Application):
+    await BROADCASTS.stop()
+    await SHOTS.stop()
+    for task in list(EXPORTS):
+        task.cancel()
+    if DIGEST:
+        await DIGEST.stop()
+    await OUTBOX.stop()
+    await USERS.stop()
+    await TIMERS.stop()
+    await CATALOG.stop()
+    await MONITOR.stop()
+
+async def main():
+    app = build()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await on_startup(app)
+        if WEBHOOK_URL:
+            HTTP_ROUTES["POST", WEBHOOK_PATH] = webhook_route
+        server = await start_http_server(app)
+
+        if WEBHOOK_URL:
+            if WEBHOOK_REGISTER:
+                await app.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            logging.info("Webhook mode on port %s%s", PORT, WEBHOOK_PATH)
+        else:
+            # Ensure no webhook & drop old updates to avoid getUpdates conflict
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            await app.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+            logging.info("Polling mode (health on port %s)", PORT)
+
+        await app.start()
+        await stop.wait()
+
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        server.close()
+        await server.wait_closed()
+        await on_shutdown(app)
+    DB.close()
 
-    app.post_init = on_startup
-    app.run_polling(drop_pending_updates=True)
+if __name__ == "__main__":
+    asyncio.run(main())
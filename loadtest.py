@@ -0,0 +1,276 @@
+# End-to-end load test: runs bot.py against a local Bot API stand-in and
+# drives simulated customers through the full purchase flow. Runs offline:
+#   python loadtest.py --users 2000 --concurrency 200 --latency 0.02 --rate-429 0.01
+import argparse
+import asyncio
+import email
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl
+
+FAKE_API_PORT = int(os.getenv("FAKE_API_PORT", 18999))
+
+_tmp = tempfile.mkdtemp(prefix="bot-load-")
+os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+os.environ["BOT_API_URL"] = f"http://127.0.0.1:{FAKE_API_PORT}"
+os.environ.setdefault("DB_FILE", os.path.join(_tmp, "bot.db"))
+os.environ.setdefault("USERS_LOG", os.path.join(_tmp, "users.log"))
+os.environ.setdefault("WORKER_ID", "0")  # one process; required with STATE_BACKEND=sqlite
+
+import bot  # noqa: E402
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendInvoice", "sendDocument", "sendMediaGroup", "editMessageText"}
+
+
+# ================== FAKE BOT API ==================
+class FakeBotAPI:
+    # Just enough of the Bot API for the bot's flows. Every send resolves the
+    # waiter registered for its chat, which is how the driver times a step.
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0):
+        self.latency, self.jitter, self.rate_429 = latency, jitter, rate_429
+        self.updates = deque()
+        self.calls = defaultdict(int)
+        self.injected_429 = 0
+        self.waiters = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+
+    def push(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        self.updates.append(update)
+        self._new_updates.set()
+
+    def expect(self, key) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[key] = fut
+        return fut
+
+    def _resolve(self, key, value):
+        fut = self.waiters.pop(key, None)
+        if fut and not fut.done():
+            fut.set_result(value)
+
+    async def _get_updates(self, params: dict) -> dict:
+        offset = int(params.get("offset") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and float(params.get("timeout") or 0):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params["timeout"]), 1))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return {"ok": True, "result": list(itertools.islice(self.updates, limit))}
+
+    async def handle(self, method: str, params: dict) -> dict:
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return {"ok": True, "result": BOT_USER}
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if method in SEND_METHODS and random.random() < self.rate_429:
+            self.injected_429 += 1
+            return {
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }
+
+        if method in SEND_METHODS:
+            chat_id = int(params["chat_id"])
+            self._resolve(("chat", chat_id), method)
+            msg = {
+                "message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+            }
+            if "text" in params:
+                msg["text"] = params["text"]
+            return {"ok": True, "result": [msg] if method == "sendMediaGroup" else msg}
+        if method == "answerPreCheckoutQuery":
+            self._resolve(("pcq", params["pre_checkout_query_id"]), params.get("ok"))
+        return {"ok": True, "result": True}
+
+
+def parse_params(ctype: str, body: bytes, target: str) -> dict:
+    params = dict(parse_qsl(target.partition("?")[2]))
+    if not body:
+        return params
+    if ctype.startswith("application/json"):
+        params.update(json.loads(body))
+    elif ctype.startswith("multipart/form-data"):
+        msg = email.message_from_bytes(f"Content-Type: {ctype}\r\n\r\n".encode() + body)
+        for part in msg.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            data = part.get_payload(decode=True)
+            params[name] = data if part.get_filename() else data.decode()
+    else:
+        params.update(parse_qsl(body.decode()))
+    return params
+
+
+async def serve_conn(api: FakeBotAPI, reader, writer):
+    try:
+        while True:
+            req = await bot._http_request(reader)
+            if req is None:
+                break
+            _, target, headers, body = req
+            method = target.partition("?")[0].rsplit("/", 1)[-1]
+            result = await api.handle(method, parse_params(headers.get("content-type", ""), body or b"", target))
+            payload = json.dumps(result).encode()
+            writer.write(
+                f"HTTP/1.1 {result.get('error_code', 200)} X\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+    except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+            asyncio.CancelledError):
+        # CancelledError: the harness is shutting down with polls still open
+        pass
+    finally:
+        writer.close()
+
+
+# ================== DRIVER ==================
+class StepFailed(Exception):
+    pass
+
+
+class Driver:
+    def __init__(self, api: FakeBotAPI, args):
+        self.api, self.args = api, args
+        self.latency = defaultdict(list)
+        self.failed = defaultdict(int)
+        self.completed = 0
+        self._ids = itertools.count(1)
+
+    def _message(self, user: dict, **extra) -> dict:
+        return {"message": {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"}, "from": user, **extra,
+        }}
+
+    def _callback(self, user: dict, data: str) -> dict:
+        return {"callback_query": {
+            "id": f"cq{next(self._ids)}", "from": user, "chat_instance": "load", "data": data,
+            "message": {"message_id": 1, "date": 0, "chat": {"id": user["id"], "type": "private"}},
+        }}
+
+    async def step(self, name: str, key, update: dict):
+        fut = self.api.expect(key)
+        t = time.perf_counter()
+        self.api.push(update)
+        try:
+            await asyncio.wait_for(fut, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.api.waiters.pop(key, None)
+            self.failed[name] += 1
+            raise StepFailed(name)
+        self.latency[name].append(time.perf_counter() - t)
+
+    async def flow(self, i: int):
+        user = {"id": 10_000_000 + i, "is_bot": False, "first_name": f"User{i}"}
+        chat = ("chat", user["id"])
+        key = random.choice(list(bot.SERVICES))
+        svc = bot.SERVICES[key]
+
+        await self.step("start", chat, self._message(
+            user, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]))
+        await self.step("lang", chat, self._callback(user, "lang:EN"))
+        await self.step("service", chat, self._callback(user, f"svc:{key}"))
+
+        if random.random() < self.args.stars_ratio:
+            await self.step("pay_stars", chat, self._callback(user, "pay_stars"))
+            qid = f"pcq{i}"
+            payload = f"stars:{key}:{svc['stars']}"
+            await self.step("precheckout", ("pcq", qid), {"pre_checkout_query": {
+                "id": qid, "from": user, "currency": "XTR", "total_amount": svc["stars"],
+                "invoice_payload": payload,
+            }})
+            await self.step("stars_success", chat, self._message(user, successful_payment={
+                "currency": "XTR", "total_amount": svc["stars"], "invoice_payload": payload,
+                "telegram_payment_charge_id": f"charge{i}", "provider_payment_charge_id": "",
+            }))
+        else:
+            await self.step("pay_usdt", chat, self._callback(user, "pay_usdt"))
+            await self.step("paid", chat, self._callback(user, "paid"))
+            await self.step("photo", chat, self._message(user, photo=[
+                {"file_id": f"photo{i}", "file_unique_id": f"uniq{i}", "width": 320, "height": 640},
+            ]))
+
+        await self.step("email", chat, self._message(user, text=f"user{i}@example.com"))
+        self.completed += 1
+
+
+def pct(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+def report(driver: Driver, api: FakeBotAPI, wall: float, users: int):
+    print(f"{'step':<15}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'failed':>8}")
+    for name in dict.fromkeys([*driver.latency, *driver.failed]):
+        v = sorted(driver.latency[name])
+        print(f"{name:<15}{len(v):>7}{pct(v, .5):>10.1f}{pct(v, .95):>10.1f}{pct(v, .99):>10.1f}"
+              f"{driver.failed[name]:>8}")
+    steps = sum(len(v) for v in driver.latency.values())
+    print(f"\nflows completed: {driver.completed}/{users} in {wall:.1f}s "
+          f"({driver.completed / wall:.1f} flows/s, {steps / wall:.1f} steps/s)")
+    print(f"429s injected: {api.injected_429}, outbox backlog at end: {len(bot.OUTBOX)}")
+    print("API calls:", dict(sorted(api.calls.items())))
+
+
+async def main(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_429)
+    server = await asyncio.start_server(lambda r, w: serve_conn(api, r, w), "127.0.0.1", FAKE_API_PORT)
+
+    app = bot.build()
+    async with app:
+        await bot.on_startup(app)
+        await app.updater.start_polling(poll_interval=0, timeout=1)
+        await app.start()
+
+        driver = Driver(api, args)
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with sem:
+                try:
+                    await driver.flow(i)
+                except StepFailed:
+                    pass
+
+        t = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.users)))
+        wall = time.perf_counter() - t
+
+        await app.updater.stop()
+        await app.stop()
+        await bot.on_shutdown(app)
+    server.close()
+    bot.DB.close()
+    report(driver, api, wall, args.users)
+
+
+if __name__ == "__main__":
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=100, help="users in flight at once")
+    ap.add_argument("--stars-ratio", type=float, default=0.3, help="share of users paying with Stars")
+    ap.add_argument("--latency", type=float, default=0.0, help="fake API latency per call (s)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="extra random latency (s)")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="probability a send returns 429")
+    ap.add_argument("--step-timeout", type=float, default=15.0)
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,13 @@
+# bot.py reads its configuration at import: point it at a throwaway database
+# and users log before the tests import it.
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="bot-test-")
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("DB_FILE", os.path.join(_tmp, "bot.db"))
+os.environ.setdefault("USERS_LOG", os.path.join(_tmp, "users.log"))
+os.environ.setdefault("WORKER_ID", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import threading
+
+import bot
+
+THREADS = 4
+PER_THREAD = 5000
+
+
+def decode(oid: str) -> tuple:
+    # (ms, worker, seq) of an "O" + base36 order id
+    n = int(oid[1:], 36)
+    return n >> 22, (n >> 12) & 0x3FF, n & 0xFFF
+
+
+def hammer(gen) -> list:
+    # ids per thread, each list in the order that thread got them
+    out = [[] for _ in range(THREADS)]
+    start = threading.Barrier(THREADS)
+
+    def run(ids):
+        start.wait()
+        for _ in range(PER_THREAD):
+            ids.append(gen())
+
+    threads = [threading.Thread(target=run, args=(ids,)) for ids in out]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out
+
+
+def test_ids_unique_and_ordered_across_threads_and_workers():
+    gens = {1: bot.OrderIdGenerator(1), 2: bot.OrderIdGenerator(2)}
+    per_worker = {w: [] for w in gens}
+
+    def run_worker(w):
+        per_worker[w] = hammer(gens[w])
+
+    workers = [threading.Thread(target=run_worker, args=(w,)) for w in gens]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    every = [oid for lists in per_worker.values() for ids in lists for oid in ids]
+    assert len(every) == len(gens) * THREADS * PER_THREAD
+    assert len(set(every)) == len(every)
+    assert all(len(oid) == 14 for oid in every)
+
+    for w, lists in per_worker.items():
+        for ids in lists:
+            # each caller sees strictly increasing ids, as strings and as numbers
+            assert all(a < b for a, b in zip(ids, ids[1:]))
+            assert all(decode(oid)[1] == w for oid in ids)
+
+
+def test_ids_keep_increasing_when_the_clock_stalls_or_goes_back(monkeypatch):
+    now = [1_800_000_000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    gen = bot.OrderIdGenerator(3)
+
+    ids = [gen() for _ in range(10_000)]  # > 4096 per ms: the sequence wraps
+    now[0] -= 5  # clock steps back
+    ids += [gen() for _ in range(100)]
+
+    assert all(a < b for a, b in zip(ids, ids[1:]))
+    assert decode(ids[-1])[0] > decode(ids[0])[0]  # borrowed the following ms
@@ -0,0 +1,24 @@
+import asyncio
+
+import bot
+
+
+def test_counts_match_the_orders_table(tmp_path):
+    db = bot.Database(str(tmp_path / "bot.db"))
+    store = bot.OrderStore(db)
+
+    async def scenario():
+        for i in range(6):
+            await store.create(f"o{i}", {"user": i, "pay": "STARS" if i % 2 else "USDT", "service": "s",
+                                         "price": "$5", "created_at": 0, "status": "WAITING_ADMIN"})
+        await store.set_status("o0", "CONFIRMED")
+        await store.set_status("o0", "REFUNDED")
+        await store.set_status("o1", "CANCELLED")
+        await store.set_status_many(["o2", "o3", "o4"], "EXPIRED")
+        return await store.counts()
+
+    counts = {(status, pay): n for status, pay, n in asyncio.run(scenario()) if n}
+    def q(conn):
+        return {(s, p): n for s, p, n in conn.execute("SELECT status, pay, COUNT(*) FROM orders GROUP BY 1, 2")}
+    assert counts == db.run_sync(q)
+    db.close()
@@ -0,0 +1,52 @@
+import asyncio
+import datetime
+import random
+
+from telegram import Chat, Message, Update
+
+import bot
+
+CHATS = 200
+PER_CHAT = 10
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat))
+
+
+async def feed(proc, updates, handler):
+    # like Application's fetcher: one task per update, created in arrival order
+    await asyncio.gather(*(asyncio.create_task(proc.process_update(u, handler(u))) for u in updates))
+
+
+def test_per_chat_order_and_concurrency_cap():
+    rng = random.Random(10)
+    limit = bot.MAX_CONCURRENT_UPDATES
+    arrivals = [chat for chat in range(1, CHATS + 1) for _ in range(PER_CHAT)]
+    rng.shuffle(arrivals)  # chats interleaved
+    updates = [make_update(i, chat) for i, chat in enumerate(arrivals, 1)]
+
+    ran = {}   # chat id -> update ids in the order their handlers ran
+    state = {"in_flight": 0, "peak": 0, "chats_busy": set()}
+
+    async def handler(update):
+        chat = update.effective_chat.id
+        assert chat not in state["chats_busy"], "two updates of one chat ran at once"
+        state["chats_busy"].add(chat)
+        state["in_flight"] += 1
+        state["peak"] = max(state["peak"], state["in_flight"])
+        ran.setdefault(chat, []).append(update.update_id)
+        await asyncio.sleep(rng.uniform(0, 0.003))
+        state["in_flight"] -= 1
+        state["chats_busy"].discard(chat)
+
+    proc = bot.PerChatUpdateProcessor(limit)
+    asyncio.run(feed(proc, updates, handler))
+
+    for chat, ids in ran.items():
+        assert ids == sorted(ids), f"chat {chat} ran out of order"
+    assert sum(map(len, ran.values())) == len(updates)
+    assert state["peak"] <= limit
+    assert state["peak"] > 1  # chats did run concurrently
+    assert not proc._chats  # per-chat locks are dropped once drained
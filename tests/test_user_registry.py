@@ -0,0 +1,55 @@
+import asyncio
+
+import bot
+
+
+def test_torn_last_line_is_cut_before_the_next_append(tmp_path):
+    path = tmp_path / "users.log"
+    path.write_text("11 W=2900\n22 W=2900\n33")  # crash in the middle of "33…"
+
+    users = bot.UserRegistry(str(path))
+    assert sorted(users) == [11, 22]
+    users.add(456)
+    asyncio.run(users.flush())
+
+    assert path.read_text().startswith("11 W=2900\n22 W=2900\n456 ")
+    assert sorted(bot.UserRegistry(str(path))) == [11, 22, 456]
+
+
+def _db_with_orders(tmp_path, users):
+    db = bot.Database(str(tmp_path / "bot.db"))
+    store = bot.OrderStore(db)
+    for i, uid in enumerate(users):
+        asyncio.run(store.create(f"o{i}", {"user": uid, "created_at": 0, "status": "CONFIRMED"}))
+    return db
+
+
+def test_past_customers_are_backfilled_as_purchased_once(tmp_path):
+    db = _db_with_orders(tmp_path, [22, 33, 33])
+    path = tmp_path / "users.log"
+    path.write_text("11\n-22\n")
+
+    users = bot.UserRegistry(str(path), db=db)
+    assert asyncio.run(users.count("-:Y:0")) == 1  # 22 has blocked the bot
+    assert asyncio.run(users.count("-:N:0")) == 1
+    asyncio.run(users.flush())
+    assert path.read_text() == "11\n-22\n-22 P=1\n33 P=1\n"
+
+    # new orders tag their user themselves; the backfill does not run again
+    asyncio.run(bot.OrderStore(db).create("o9", {"user": 44, "created_at": 0, "status": "CONFIRMED"}))
+    users = bot.UserRegistry(str(path), db=db)
+    assert asyncio.run(users.count("-:Y:0")) == 1
+    assert path.read_text() == "11\n-22\n-22 P=1\n33 P=1\n"
+    db.close()
+
+
+def test_past_customers_are_backfilled_in_the_users_table(tmp_path):
+    db = _db_with_orders(tmp_path, [22, 33])
+    db.run_sync(lambda conn: conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY)"))
+    db.run_sync(lambda conn: conn.executemany("INSERT INTO users VALUES (?)", [(11,), (22,)]))
+
+    users = bot.SqliteUserRegistry(db)
+    assert len(users) == 3
+    assert asyncio.run(users.count("-:Y:0")) == 2
+    assert asyncio.run(users.count("-:N:0")) == 1
+    db.close()